@@ -67,6 +67,7 @@ if DEBUG:
 DEBUG_TOOLBAR_CONFIG['IS_RUNNING_TESTS'] = False  # I don't like this, but was unable to get it to work otherwise
 
 MIDDLEWARE = [
+    'request.metrics.view_metrics_middleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -162,12 +163,40 @@ DRAMATIQ_BROKER = {
         "dramatiq.middleware.AgeLimit",
         "dramatiq.middleware.TimeLimit",
         "dramatiq.middleware.Callbacks",
+        "dramatiq.middleware.Pipelines",
         "dramatiq.middleware.Retries",
         "django_dramatiq.middleware.DbConnectionsMiddleware",
         "django_dramatiq.middleware.AdminMiddleware",
+        "request.metrics.ActorMetrics",
     ]
 }
 
+# Approved requests are activated on their inception date and torn down this many hours after party_end
+# by the auto_provision actor, at most AUTO_PROVISIONING_MAX_IN_FLIGHT requests are provisioning at once
+AUTO_PROVISIONING = env.bool('AUTO_PROVISIONING', default=False)
+AUTO_TEARDOWN_GRACE_HOURS = env.int('AUTO_TEARDOWN_GRACE_HOURS', default=24)
+AUTO_PROVISIONING_MAX_IN_FLIGHT = env.int('AUTO_PROVISIONING_MAX_IN_FLIGHT', default=3)
+
+# Concurrent calls to each provider across all workers, enforced by request/limits.py in PROVIDER_LIMITER_URL
+PROVIDER_CONCURRENCY = {
+    "upcloud": env.int('UPCLOUD_MAX_CONCURRENCY', default=4),
+    "cloudflare": env.int('CLOUDFLARE_MAX_CONCURRENCY', default=4),
+}
+PROVIDER_LIMITER_URL = env.str('PROVIDER_LIMITER_URL', default=DRAMATIQ_BROKER["OPTIONS"]["url"])
+
+# Modules rundramatiq imports from every app to find actors
+DRAMATIQ_AUTODISCOVER_MODULES = ["tasks", "reconcile"]
+
+# Directories the /metrics view aggregates in prometheus_client multiprocess mode, one per container. Every
+# gunicorn and Dramatiq process writes its samples to the PROMETHEUS_MULTIPROC_DIR it was started with.
+PROMETHEUS_MULTIPROC_DIRS = env.list('PROMETHEUS_MULTIPROC_DIRS',
+                                     default=[path for path in [os.environ.get('PROMETHEUS_MULTIPROC_DIR')] if path])
+if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+    # prometheus_client expects the directory to exist, gunicorn.conf.py empties it when gunicorn starts
+    os.makedirs(os.environ['PROMETHEUS_MULTIPROC_DIR'], exist_ok=True)
+# Bearer token /metrics asks for, served to anyone when empty
+METRICS_TOKEN = env.str('METRICS_TOKEN', default='')
+
 DRAMATIQ_RESULT_BACKEND = {
     "BACKEND": "dramatiq.results.backends.redis.RedisBackend",
     "BACKEND_OPTIONS": {
@@ -183,3 +212,5 @@ CRISPY_ALLOWED_TEMPLATE_PACKS = "bootstrap5"
 CRISPY_TEMPLATE_PACK = "bootstrap5"
 
 FERNET_ENCRYPTION_KEY = env.str('FERNET_ENCRYPTION_KEY')
+# Old keys that can still decrypt, see the rotate_encryption_keys management command
+FERNET_PREVIOUS_KEYS = env.list('FERNET_PREVIOUS_KEYS', default=[])
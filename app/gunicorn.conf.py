@@ -0,0 +1,18 @@
+import os
+import shutil
+
+# gunicorn reads this file from the working directory. In prometheus_client multiprocess mode every worker
+# writes its samples to a file of its own in PROMETHEUS_MULTIPROC_DIR, the files of the previous run are
+# removed before the first worker starts so that /metrics does not add them to the new ones. The directory
+# itself is kept, /metrics may be reading it at the same time.
+
+
+def on_starting(server):
+    path = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+    if path:
+        os.makedirs(path, exist_ok=True)
+        for entry in os.scandir(path):
+            if entry.is_dir():
+                shutil.rmtree(entry.path, ignore_errors=True)
+            else:
+                os.remove(entry.path)
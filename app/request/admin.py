@@ -1,13 +1,20 @@
 import json
+from functools import partial
 
-from django.contrib import admin
+from django.contrib import admin, messages
+from django.db import transaction
+from django.http import HttpResponseRedirect, JsonResponse
+from django.template.response import TemplateResponse
+from django.urls import path, reverse
+from django.utils.html import format_html
 
 from request.forms import AppSettingsForm
 from request.models import Request, UpCloudZone, CloudflareZone, UpCloudPlan, SSHKeys, PortfolioItem, ExternalURL, \
     Testimonial, \
-    Email, AppSettings
-from request.email import generate_request_activation_email, generate_request_received_email
-from request.helpers import duplicate_request
+    Email, AppSettings, CatalogSync, ProvisioningState
+from request.email import queue_request_emails
+from request.helpers import CloudflareDNSIndex, duplicate_request
+from request.tasks import queue_activation, queue_deactivation, send_queued_emails, delete_dns_records
 
 
 class ExternalURLInline(admin.TabularInline):
@@ -47,17 +54,131 @@ class RequestAdmin(admin.ModelAdmin):
     list_filter = ['party_start', 'party_end', 'upcloud_zone', 'cloudflare_zone', 'is_approved', 'activated',
                    'deactivated', 'created', 'modified']
     search_fields = ['party_name', 'domain', 'cloudflare_zone__name', 'upcloud_zone__name']
-    actions = ['send_request_email', 'send_activation_email', 'replicate_request']
+    actions = ['send_request_email', 'send_activation_email', 'replicate_request', 'activate_requests',
+               'deactivate_requests']
 
     def send_request_email(self, request, queryset):
-        for row in queryset:
-            generate_request_received_email(row)
-        self.message_user(request, f"Successfully sent {queryset.count()} request email(s).")
+        self._queue_emails(request, queryset, "request-received.html", "request")
 
     def send_activation_email(self, request, queryset):
-        for row in queryset:
-            generate_request_activation_email(row)
-        self.message_user(request, f"Successfully sent {queryset.count()} activation email(s).")
+        self._queue_emails(request, queryset, "request-activated.html", "activation")
+
+    def _queue_emails(self, request, queryset, template_file, kind):
+        emails, failures = queue_request_emails(list(queryset.select_related("cloudflare_zone")), template_file)
+        for row, exc in failures:
+            self.message_user(request, f"Could not render the {kind} email for {row} ({row.contact_email}): {exc}",
+                              messages.ERROR)
+        if not emails:
+            return
+        transaction.on_commit(send_queued_emails.send)
+        url = reverse("admin:request_email_changelist") + "?id__in=" + ",".join(str(email.pk) for email in emails)
+        self.message_user(request, format_html(
+            'Queued {} {} email(s), <a href="{}">follow the delivery status of each recipient</a>.',
+            len(emails), kind, url))
+
+    def activate_requests(self, request, queryset):
+        rows = list(queryset.select_related("cloudflare_zone", "upcloud_zone", "upcloud_plan"))
+        selected = [row for row in rows if self._can_change_activation(request, row, activate=True)]
+        if not selected:
+            return
+
+        # One listing per zone answers the domain checks of every pipeline from the DNS index cache
+        try:
+            for zone, zone_rows in self._by_zone(selected).items():
+                if not AppSettings.load().sandbox_mode:
+                    CloudflareDNSIndex(zone).prefetch([f"{row.domain}.{zone.name}" for row in zone_rows])
+        except Exception as exc:
+            self.message_user(request, f"Could not prefetch DNS records, each activation checks its own: {exc}",
+                              messages.WARNING)
+
+        with transaction.atomic():
+            for row in selected:
+                queue_activation(row, request.user)
+                row.save()
+        return self._bulk_status_redirect(selected)
+
+    def deactivate_requests(self, request, queryset):
+        rows = list(queryset.select_related("cloudflare_zone"))
+        selected = [row for row in rows if self._can_change_activation(request, row, activate=False)]
+        if not selected:
+            return
+
+        with transaction.atomic():
+            # The DNS records go in one batch per zone, deprovision_request skips the records it has deleted
+            for zone, zone_rows in self._by_zone(selected).items():
+                ids = [row.pk for row in zone_rows if row.cloudflare_dns_record_id]
+                if zone and ids:
+                    transaction.on_commit(partial(delete_dns_records.send, zone.pk, ids))
+            for row in selected:
+                queue_deactivation(row, request.user)
+                row.save()
+        return self._bulk_status_redirect(selected)
+
+    def _can_change_activation(self, request, row, activate):
+        if row.provisioning_state in ProvisioningState.in_progress():
+            reason = f"it is busy: {row.get_provisioning_state_display()}"
+        elif activate and row.activated:
+            # a deactivated request keeps the ids of its deleted server and DNS record, duplicate it instead
+            reason = "it has been deactivated" if row.deactivated else "it is already active"
+        elif activate and (not row.upcloud_zone or not row.upcloud_plan):
+            reason = "zone or plan is not set"
+        elif not activate and (not row.activated or row.deactivated):
+            reason = "it is not active"
+        else:
+            return True
+        self.message_user(request, f"Skipped {row} ({row.domain}), {reason}", messages.WARNING)
+        return False
+
+    @staticmethod
+    def _by_zone(rows):
+        zones = {}
+        for row in rows:
+            zones.setdefault(row.cloudflare_zone, []).append(row)
+        return zones
+
+    @staticmethod
+    def _bulk_status_redirect(rows):
+        url = reverse("admin:request_request_bulk_status")
+        return HttpResponseRedirect(f"{url}?ids={','.join(str(row.pk) for row in rows)}")
+
+    def get_urls(self):
+        return [
+            path("bulk-status/", self.admin_site.admin_view(self.bulk_status_view),
+                 name="request_request_bulk_status"),
+            path("bulk-status/states/", self.admin_site.admin_view(self.bulk_states_view),
+                 name="request_request_bulk_states"),
+            *super().get_urls(),
+        ]
+
+    @staticmethod
+    def _bulk_ids(request):
+        return [int(pk) for pk in request.GET.get("ids", "").split(",") if pk.isdigit()]
+
+    def bulk_status_view(self, request):
+        """Lists the requests of a bulk action, the page follows their provisioning through bulk_states_view"""
+        context = {
+            **self.admin_site.each_context(request),
+            "opts": self.model._meta,
+            "title": "Bulk activation status",
+            "rows": Request.objects.filter(pk__in=self._bulk_ids(request)).select_related("cloudflare_zone")
+            .order_by("pk"),
+            "ids": request.GET.get("ids", ""),
+        }
+        return TemplateResponse(request, "admin/request/request/bulk_status.html", context)
+
+    def bulk_states_view(self, request):
+        """
+        Provisioning state of every request on the bulk status page in one query. Read from the database only,
+        polling the providers for a whole season of requests would bypass the provider_slot caps.
+        """
+        in_progress = ProvisioningState.in_progress()
+        rows = Request.objects.filter(pk__in=self._bulk_ids(request)).only(
+            "provisioning_state", "provisioning_error")
+        return JsonResponse({str(row.pk): {
+            "state_display": row.get_provisioning_state_display(),
+            "in_progress": row.provisioning_state in in_progress,
+            "error": row.provisioning_error,
+        } for row in rows})
 
     def replicate_request(self, request, queryset):
         for row in queryset:
@@ -67,25 +188,37 @@ class RequestAdmin(admin.ModelAdmin):
 
 @admin.register(UpCloudZone)
 class UpCloudZoneAdmin(admin.ModelAdmin):
-    list_display = ['id', 'name', 'visible']
+    list_display = ['id', 'name', 'visible', 'missing_since']
     list_filter = ['created', 'modified', 'visible']
     search_fields = ['name']
 
 
 @admin.register(UpCloudPlan)
 class UpCloudPlanAdmin(admin.ModelAdmin):
-    list_display = ['id', 'name', 'description', 'visible']
+    list_display = ['id', 'name', 'description', 'visible', 'missing_since']
     list_filter = ['created', 'modified', 'visible']
     search_fields = ['name']
 
 
 @admin.register(CloudflareZone)
 class CloudflareZoneAdmin(admin.ModelAdmin):
-    list_display = ['id', 'name', 'cloudflare_id', 'public', 'visible', 'created', 'modified']
+    list_display = ['id', 'name', 'cloudflare_id', 'public', 'visible', 'missing_since', 'created', 'modified']
     list_filter = ['created', 'modified', 'public']
     search_fields = ['name']
 
 
+@admin.register(CatalogSync)
+class CatalogSyncAdmin(admin.ModelAdmin):
+    list_display = ['catalog', 'started', 'duration', 'created', 'renamed', 'hidden', 'unhidden', 'error']
+    list_filter = ['catalog', 'started']
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+
 @admin.register(SSHKeys)
 class SSHKeysAdmin(admin.ModelAdmin):
     list_display = ('id', 'user', 'public_key', 'created')
@@ -99,9 +232,9 @@ class PrettyJSONEncoder(json.JSONEncoder):
 
 @admin.register(Email)
 class EmailLogAdmin(admin.ModelAdmin):
-    list_display = ['id', 'recipients', 'created', 'modified']
-    list_filter = ['created', 'modified']
-    readonly_fields = ['recipients', 'created', 'modified']
+    list_display = ['id', 'recipients', 'status', 'created', 'sent']
+    list_filter = ['status', 'created', 'modified', 'sent']
+    readonly_fields = ['recipients', 'status', 'sent', 'created', 'modified']
     search_fields = ['recipients', 'text_content', 'html_content']
 
     def get_form(self, request, obj=None, change=False, **kwargs):
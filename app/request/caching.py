@@ -0,0 +1,54 @@
+import time
+from uuid import uuid4
+
+from django.core.cache import cache
+
+# Content version of the rendered landing page, bumped when portfolio content changes
+LANDING_PAGE = "landingpage"
+
+# Seconds a single-flight fill may take before another process is allowed to try
+FILL_LOCK_TIMEOUT = 30
+# Seconds a process waits for another process' fill before rendering on its own
+FILL_WAIT = 5.0
+
+
+def get_version(name: str) -> str:
+    """Returns the current content version called `name`, used as part of cache keys"""
+    version = cache.get(f"{name}:version")
+    if version is None:
+        version = bump_version(name)
+    return version
+
+
+def bump_version(name: str) -> str:
+    """Moves the content version to a new value, making every key built from the old one unreachable"""
+    version = uuid4().hex
+    cache.set(f"{name}:version", version, timeout=None)
+    return version
+
+
+def single_flight(key: str, fill, timeout: int):
+    """
+    Returns the cached value of `key`. On a miss only the process that gets the fill lock calls `fill()`,
+    the others wait for its result instead of all computing the same value at once.
+    """
+    value = cache.get(key)
+    if value is not None:
+        return value
+
+    lock_key = f"{key}:lock"
+    if cache.add(lock_key, 1, FILL_LOCK_TIMEOUT):
+        try:
+            value = fill()
+            cache.set(key, value, timeout)
+        finally:
+            cache.delete(lock_key)
+        return value
+
+    deadline = time.monotonic() + FILL_WAIT
+    while time.monotonic() < deadline:
+        time.sleep(0.05)
+        value = cache.get(key)
+        if value is not None:
+            return value
+    return fill()
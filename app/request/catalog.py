@@ -0,0 +1,146 @@
+import logging
+import time
+
+from django.db import transaction
+from django.utils import timezone
+
+from request.clients import get_cloudflare_client, get_upcloud_client
+from request.limits import CLOUDFLARE, UPCLOUD
+from request.metrics import external_call
+from request.models import AppSettings, CatalogSync, CloudflareZone, UpCloudPlan, UpCloudZone
+
+logger = logging.getLogger(__name__)
+
+CLOUDFLARE_ZONES_PER_PAGE = 50
+
+
+class Catalog:
+    """
+    A list of things a provider offers, mirrored into `model`. Rows are matched on `key_field`, the fields
+    returned by fetch() are kept up to date and `defaults` are only set when a row is created, so values
+    edited in the admin (plan descriptions, public zones) are left alone.
+    """
+    name: CatalogSync.Catalog
+    model = None
+    key_field = "name"
+
+    def fetch(self) -> dict[str, dict]:
+        """Returns every entry the provider lists as key -> synced fields"""
+        raise NotImplementedError
+
+    def defaults(self, fields: dict) -> dict:
+        return {}
+
+
+class CloudflareZoneCatalog(Catalog):
+    name = CatalogSync.Catalog.CLOUDFLARE_ZONES
+    model = CloudflareZone
+    key_field = "cloudflare_id"
+
+    def fetch(self):
+        # Iterating the page follows the pagination until every zone has been read
+        with external_call(CLOUDFLARE, "list_zones"):
+            zones = get_cloudflare_client().zones.list(per_page=CLOUDFLARE_ZONES_PER_PAGE)
+            return {zone.id: {"name": zone.name} for zone in zones}
+
+
+class UpCloudZoneCatalog(Catalog):
+    name = CatalogSync.Catalog.UPCLOUD_ZONES
+    model = UpCloudZone
+
+    def fetch(self):
+        with external_call(UPCLOUD, "list_zones") as call:
+            res = get_upcloud_client().get("/1.3/zone")
+            call.record_status(res.status_code)
+        res.raise_for_status()
+        return {zone["id"]: {} for zone in res.json()["zones"]["zone"]}
+
+
+class UpCloudPlanCatalog(Catalog):
+    name = CatalogSync.Catalog.UPCLOUD_PLANS
+    model = UpCloudPlan
+
+    def fetch(self):
+        with external_call(UPCLOUD, "list_plans") as call:
+            res = get_upcloud_client().get("/1.3/plan")
+            call.record_status(res.status_code)
+        res.raise_for_status()
+        return {plan["name"]: {"_plan": plan} for plan in res.json()["plans"]["plan"]}
+
+    def defaults(self, fields):
+        # Plans are offered on the public form, new ones wait until they are shown in the admin
+        plan = fields["_plan"]
+        return {"description": f"{plan['core_number']} CPU, {plan['memory_amount'] / 1024:g} GB RAM, "
+                               f"{plan['storage_size']} GB storage",
+                "visible": False}
+
+
+CATALOGS = {catalog.name: catalog for catalog in (CloudflareZoneCatalog(), UpCloudZoneCatalog(), UpCloudPlanCatalog())}
+
+
+def apply_catalog(catalog: Catalog, remote: dict[str, dict]) -> dict[str, int]:
+    """
+    Diffs `remote` against the database and applies it in one transaction. New entries are created, changed
+    names are updated, entries the provider no longer lists are hidden and hidden ones that are listed again
+    are shown. Rows hidden by hand in the admin (visible=False without missing_since) stay hidden.
+    """
+    model = catalog.model
+    now = timezone.now()
+    counts = {"created": 0, "renamed": 0, "hidden": 0, "unhidden": 0}
+
+    with transaction.atomic():
+        existing = {getattr(obj, catalog.key_field): obj for obj in model.objects.select_for_update()}
+        to_create = []
+        to_update = {}
+        for key, fields in remote.items():
+            synced = {field: value for field, value in fields.items() if not field.startswith("_")}
+            obj = existing.get(key)
+            if obj is None:
+                to_create.append(model(**{catalog.key_field: key, **synced, **catalog.defaults(fields)}))
+                continue
+            if any(getattr(obj, field) != value for field, value in synced.items()):
+                for field, value in synced.items():
+                    setattr(obj, field, value)
+                to_update[key] = obj
+                counts["renamed"] += 1
+            if obj.missing_since:
+                obj.visible = True
+                obj.missing_since = None
+                to_update[key] = obj
+                counts["unhidden"] += 1
+
+        for key in existing.keys() - remote.keys():
+            obj = existing[key]
+            if obj.visible:
+                obj.visible = False
+                obj.missing_since = now
+                to_update[key] = obj
+                counts["hidden"] += 1
+
+        model.objects.bulk_create(to_create)
+        counts["created"] = len(to_create)
+        update_fields = ["visible", "missing_since", "modified",
+                         *{field for fields in remote.values() for field in fields if not field.startswith("_")}]
+        for obj in to_update.values():
+            obj.modified = now
+        model.objects.bulk_update(to_update.values(), update_fields)
+
+    return counts
+
+
+def sync_catalog(name: str) -> CatalogSync | None:
+    """Fetches one catalog from its provider, applies it and records the run. Does nothing in sandbox mode."""
+    if AppSettings.load().sandbox_mode:
+        return None
+
+    catalog = CATALOGS[name]
+    started = timezone.now()
+    start = time.monotonic()
+    try:
+        counts = apply_catalog(catalog, catalog.fetch())
+    except Exception as exc:
+        CatalogSync.objects.create(catalog=name, started=started, duration=time.monotonic() - start, error=str(exc))
+        raise
+    sync = CatalogSync.objects.create(catalog=name, started=started, duration=time.monotonic() - start, **counts)
+    logger.info("Synced %s in %.2f s: %s", name, sync.duration, counts)
+    return sync
@@ -0,0 +1,107 @@
+import threading
+
+import requests
+from cloudflare import Cloudflare
+from mailjet_rest import Client as MailjetClient
+from requests.adapters import HTTPAdapter
+from requests.auth import HTTPBasicAuth
+from urllib3.util.retry import Retry
+
+from request.models import AppSettings
+
+# (connect, read) in seconds. Server creation is the slowest UpCloud call and usually answers within 10 seconds.
+UPCLOUD_TIMEOUT = (5, 30)
+UPCLOUD_POOL_SIZE = 10
+
+
+class UpCloudRetry(Retry):
+    def is_retry(self, method, status_code, has_retry_after=False):
+        # A rate limited request was never processed, so it is safe to retry even when it is not idempotent
+        if status_code == 429 and self.total:
+            return True
+        return super().is_retry(method, status_code, has_retry_after)
+
+
+class UpCloudClient:
+    """
+    Keep-alive session for the UpCloud API. Idempotent requests are retried on 5xx and every request
+    is retried on 429, with exponential backoff and jitter. All requests have connect and read timeouts.
+    """
+
+    def __init__(self, base_url: str, username: str, password: str):
+        self.base_url = base_url.rstrip("/")
+        retry = UpCloudRetry(
+            total=3,
+            backoff_factor=0.5,
+            backoff_jitter=0.5,
+            status_forcelist=(429, 500, 502, 503, 504),
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(max_retries=retry, pool_connections=1, pool_maxsize=UPCLOUD_POOL_SIZE)
+        self.session = requests.Session()
+        self.session.auth = HTTPBasicAuth(username, password)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def request(self, method: str, path: str, **kwargs) -> requests.Response:
+        kwargs.setdefault("timeout", UPCLOUD_TIMEOUT)
+        return self.session.request(method, self.base_url + path, **kwargs)
+
+    def get(self, path: str, **kwargs) -> requests.Response:
+        return self.request("GET", path, **kwargs)
+
+    def post(self, path: str, **kwargs) -> requests.Response:
+        return self.request("POST", path, **kwargs)
+
+    def delete(self, path: str, **kwargs) -> requests.Response:
+        return self.request("DELETE", path, **kwargs)
+
+    def close(self):
+        self.session.close()
+
+
+_lock = threading.Lock()
+_upcloud_client: tuple[tuple, UpCloudClient] | None = None
+
+
+def get_upcloud_client() -> UpCloudClient:
+    """Returns the process wide UpCloud client, rebuilt only when the API url or credentials change"""
+    global _upcloud_client
+    settings = AppSettings.load()
+    key = (settings.upcloud_api_url, settings.upcloud_api_username, settings.upcloud_api_password)
+    with _lock:
+        if _upcloud_client is None or _upcloud_client[0] != key:
+            if _upcloud_client is not None:
+                _upcloud_client[1].close()
+            _upcloud_client = (key, UpCloudClient(*key))
+        return _upcloud_client[1]
+
+
+_cloudflare_clients: dict[str, Cloudflare] = {}
+
+
+def get_cloudflare_client() -> Cloudflare:
+    """Returns the process wide Cloudflare client for the current API token, rebuilt only when the token changes"""
+    token = AppSettings.load().cloudflare_api_token
+    with _lock:
+        client = _cloudflare_clients.get(token)
+        if client is None:
+            for old_client in _cloudflare_clients.values():
+                old_client.close()
+            _cloudflare_clients.clear()
+            client = _cloudflare_clients[token] = Cloudflare(api_token=token)
+        return client
+
+
+_mailjet_client: tuple[tuple, MailjetClient] | None = None
+
+
+def get_mailjet_client() -> MailjetClient:
+    """Returns the process wide Mailjet v3.1 client, rebuilt only when the API credentials change"""
+    global _mailjet_client
+    settings = AppSettings.load()
+    key = (settings.mailjet_api_key, settings.mailjet_api_secret)
+    with _lock:
+        if _mailjet_client is None or _mailjet_client[0] != key:
+            _mailjet_client = (key, MailjetClient(auth=key, version="v3.1"))
+        return _mailjet_client[1]
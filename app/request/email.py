@@ -1,22 +1,46 @@
+import functools
 import re
-import threading
 
 from django.conf import settings
-from django.template.loader import render_to_string
+from django.template import engines
+from django.template.loader import get_template
+from django.utils import timezone
 from django.utils.html import strip_tags
-from request.models import Email, Request
+from request.clients import get_mailjet_client
+from request.metrics import MAILJET, external_call
+from request.models import Email, EmailStatus, Request
+
+# Mailjet v3.1 accepts up to 50 messages in one send call
+MAILJET_BATCH_SIZE = 50
+
+
+_STYLE_RE = re.compile(r"(.*)<style.*</style>(.*)", flags=re.DOTALL)
+
+
+@functools.cache
+def _text_template(template_file: str):
+    """
+    The plain text variant of an email template, compiled once per process from the template source without
+    the style block and the HTML tags. Emails render it instead of running strip_tags over every HTML body.
+    """
+    source = _STYLE_RE.sub(r"\1\2", get_template(template_file).template.source)
+    return engines["django"].from_string("{% autoescape off %}" + strip_tags(source.strip()) + "{% endautoescape %}")
+
+
+def _render(template_file: str, template, request: Request) -> tuple[str, str]:
+    context = {'request': request}
+    return template.render(context), _text_template(template_file).render(context).strip()
 
 
 def render_emails(request: Request, template_file: str) -> tuple[str, str]:
-    html = render_to_string(template_file, {'request': request})
-    text = re.sub(r"(.*)<style.*</style>(.*)", r"\1\2", html, count=0, flags=re.DOTALL)
-    return html, strip_tags(text.strip())
+    # get_template() hands out the compiled template from the cached template loader
+    return _render(template_file, get_template(template_file), request)
 
 
 def _generate_request_email(request: Request, subject, html, text, recipients: list = []):
     recipients = recipients if recipients else [request.contact_email]
-    customer_mail = Email(recipients=recipients, subject=subject, text_content=text, html_content=html)
-    threading.Thread(target=customer_mail.save, daemon=True).start()
+    # Queued in the outbox, the send_email signal takes care of delivery
+    Email.objects.create(recipients=recipients, subject=subject, text_content=text, html_content=html)
 
 
 def generate_request_received_admin_email(request):
@@ -35,3 +59,68 @@ def generate_request_activation_email(request):
     html, text = render_emails(request, template_file="request-activated.html")
     subject = f"Your PartyMan request: {request.party_name} {request.party_start.year}"
     _generate_request_email(request, subject, html, text)
+
+
+def queue_request_emails(requests: list[Request], template_file: str) -> tuple[list[Email], list[tuple]]:
+    """
+    Renders `template_file` for every request with one compiled template and inserts the emails into the outbox
+    with a single query. No signal fires for bulk inserts, the caller enqueues send_queued_emails once.
+    Returns the queued emails and (request, exception) pairs for the requests that failed to render.
+    """
+    template = get_template(template_file)
+    emails, failures = [], []
+    for request in requests:
+        try:
+            html, text = _render(template_file, template, request)
+        except Exception as exc:
+            failures.append((request, exc))
+            continue
+        subject = f"Your PartyMan request: {request.party_name} {request.party_start.year}"
+        emails.append(Email(recipients=[request.contact_email], subject=subject, text_content=text,
+                            html_content=html))
+    return Email.objects.bulk_create(emails), failures
+
+
+def _mailjet_message(email: Email) -> dict:
+    return {
+        "From": {
+            "Email": "partyman@partyman.cloud",
+            "Name": "PartyMan admins"
+        },
+        "To": [{"Email": x, "Name": x} for x in email.recipients],
+        "Subject": email.subject,
+        "TextPart": email.text_content,
+        "HTMLPart": email.html_content,
+        "TrackOpens": "disabled",
+        "CustomID": str(email.pk),
+    }
+
+
+def send_mailjet_batch(emails: list[Email]) -> None:
+    """
+    Sends up to MAILJET_BATCH_SIZE emails in one Mailjet call and records the result of every message on its
+    row. Raises on errors that are worth retrying (rate limit, server errors) without touching the rows.
+    """
+    messages = [_mailjet_message(email) for email in emails]
+    with external_call(MAILJET, "send") as call:
+        res = get_mailjet_client().send.create(data={"Messages": messages})
+        call.record_status(res.status_code)
+    if res.status_code == 429 or res.status_code >= 500:
+        raise RuntimeError(f"Mailjet answered {res.status_code}")
+
+    payload = res.json()
+    results = payload.get("Messages") if isinstance(payload, dict) else None
+    if not results or len(results) != len(emails):
+        # The whole call was rejected (bad credentials, malformed request), every message shares the answer
+        results = [payload] * len(emails)
+
+    now = timezone.now()
+    for email, result in zip(emails, results):
+        email.delivery_status_code = res.status_code
+        email.delivery_status_json = result
+        if isinstance(result, dict) and result.get("Status") == "success":
+            email.status = EmailStatus.SENT
+            email.sent = now
+        else:
+            email.status = EmailStatus.FAILED
+    Email.objects.bulk_update(emails, ["delivery_status_code", "delivery_status_json", "status", "sent"])
@@ -2,7 +2,9 @@ from crispy_forms.helper import FormHelper, Layout
 from crispy_forms.layout import Row, Div, ButtonHolder, Submit
 from django_cf_turnstile.fields import TurnstileCaptchaField
 from django import forms
+from django.core.exceptions import ValidationError
 from django.forms import ModelForm
+from .metrics import TURNSTILE, external_call
 from .models import Request, CloudflareZone, AppSettings
 
 
@@ -10,6 +12,18 @@ def _password_field():
     return forms.TextInput(attrs={"type": "password", "autocomplete": "current-password"})
 
 
+class TimedTurnstileCaptchaField(TurnstileCaptchaField):
+    """TurnstileCaptchaField that times the siteverify call, failed checks are counted by their error code"""
+
+    def validate(self, value):
+        with external_call(TURNSTILE, "siteverify") as call:
+            try:
+                super().validate(value)
+            except ValidationError as exc:
+                call.record_error(exc.code)
+                raise
+
+
 class AppSettingsForm(ModelForm):
     class Meta:
         model = Request
@@ -31,7 +45,7 @@ class RequestForm(ModelForm):
     cloudflare_zone = forms.ModelChoiceField(empty_label=None, queryset=None)
 
     _app_settings = AppSettings.load()
-    captcha = TurnstileCaptchaField(
+    captcha = TimedTurnstileCaptchaField(
         site_key=_app_settings.cloudflare_turnstile_key,
         secret_key=_app_settings.cloudflare_turnstile_secret,
     )
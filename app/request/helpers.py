@@ -1,13 +1,33 @@
+import functools
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
 
-from cloudflare import Cloudflare
 import requests
 from cloudflare.types.dns import ARecord
-from requests.auth import HTTPBasicAuth
 
+from django.core.cache import cache
+from django.db import connections
 from django.utils import timezone
 
-from request.models import CloudflareZone, UpCloudZone, Request, SSHKeys, AppSettings
+from request.catalog import sync_catalog
+from request.clients import get_upcloud_client, get_cloudflare_client
+from request.limits import CLOUDFLARE, UPCLOUD, provider_slot
+from request.metrics import INIT_SCRIPT, external_call
+from request.models import CatalogSync, CloudflareZone, Request, SSHKeys, AppSettings
+
+# Seconds a DNS name lookup is cached by CloudflareDNSIndex
+DNS_INDEX_TTL = 60
+# Cloudflare allows up to 5000 DNS records per page
+DNS_RECORDS_PER_PAGE = 5000
+
+INIT_SCRIPT_CACHE_KEY = "init-script"
+# Seconds the cached init script is used without asking the script host if it has changed
+INIT_SCRIPT_FRESH_FOR = 300
+INIT_SCRIPT_TIMEOUT = (5, 15)
+
+logger = logging.getLogger(__name__)
 
 BASE_UPCLOUD_PAYLOAD = {
     "server": {
@@ -47,139 +67,268 @@ BASE_UPCLOUD_PAYLOAD = {
 }
 
 
-def get_upcloud_auth() -> HTTPBasicAuth:
-    settings = AppSettings.load()
-    return HTTPBasicAuth(settings.upcloud_api_username, settings.upcloud_api_password)
+def update_cloudflare_zones() -> None:
+    sync_catalog(CatalogSync.Catalog.CLOUDFLARE_ZONES)
 
 
-def update_cloudflare_zones() -> None:
+def get_cloudflare_dns_records(zone: CloudflareZone) -> list[ARecord]:
     settings = AppSettings.load()
     if settings.sandbox_mode:
         return
-    client = Cloudflare(api_token=settings.cloudflare_api_token)
-    page = client.zones.list()
-    cloudflare_ids = {zone.id for zone in page.result}
-    existing_ids = set(CloudflareZone.objects.values_list("cloudflare_id", flat=True))
-    bulk_zones = []
-    for zone in page.result:
-        if not zone.id in existing_ids:
-            bulk_zones.append(CloudflareZone(name=zone.name, cloudflare_id=zone.id, public=False))
-    CloudflareZone.objects.bulk_create(bulk_zones)
+    client = get_cloudflare_client()
+    with external_call(CLOUDFLARE, "list_dns_records"):
+        records = client.dns.records.list(zone_id=zone.cloudflare_id)
+    return records.result
 
-    ids_to_hide = existing_ids - cloudflare_ids
-    if ids_to_hide:
-        CloudflareZone.objects.filter(cloudflare_id__in=ids_to_hide).update(visible=False)
 
+class CloudflareDNSIndex:
+    """
+    Name to record id lookups for one CloudflareZone. A miss asks Cloudflare with a server side name filter,
+    so the answer does not depend on the zone size, and the result is cached for DNS_INDEX_TTL seconds.
+    Creating and deleting records through the helpers below keeps the cache up to date.
+    """
 
-def get_cloudflare_dns_records(zone: CloudflareZone) -> list[ARecord]:
+    def __init__(self, zone: CloudflareZone):
+        self.zone = zone
+
+    def _cache_key(self, name: str) -> str:
+        return f"cloudflare-dns:{self.zone.cloudflare_id}:{name}"
+
+    def lookup(self, name: str) -> str | None:
+        """Returns the id of the record called `name` (a fully qualified domain) or None"""
+        record_id = cache.get(self._cache_key(name))
+        if record_id is None:
+            with external_call(CLOUDFLARE, "find_dns_record"):
+                records = get_cloudflare_client().dns.records.list(zone_id=self.zone.cloudflare_id,
+                                                                    name={"exact": name}, per_page=1)
+            record_id = records.result[0].id if records.result else ""
+            cache.set(self._cache_key(name), record_id, DNS_INDEX_TTL)
+        return record_id or None
+
+    def exists(self, name: str) -> bool:
+        return self.lookup(name) is not None
+
+    def prefetch(self, names: list[str]) -> None:
+        """Answers the lookups of many names with one listing of the zone's A records instead of one call each"""
+        with external_call(CLOUDFLARE, "list_dns_records"):
+            records = get_cloudflare_client().dns.records.list(zone_id=self.zone.cloudflare_id, type="A",
+                                                                per_page=DNS_RECORDS_PER_PAGE)
+            found = {record.name: record.id for record in records}
+        cache.set_many({self._cache_key(name): found.get(name, "") for name in names}, DNS_INDEX_TTL)
+
+    def add(self, name: str, record_id: str) -> None:
+        cache.set(self._cache_key(name), record_id, DNS_INDEX_TTL)
+
+    def remove(self, name: str) -> None:
+        cache.set(self._cache_key(name), "", DNS_INDEX_TTL)
+
+
+def cloudflare_dns_record_exists(zone: CloudflareZone, domain: str) -> bool:
     settings = AppSettings.load()
     if settings.sandbox_mode:
-        return
-    client = Cloudflare(api_token=settings.cloudflare_api_token)
-    records = client.dns.records.list(zone_id=zone.cloudflare_id)
-    return records.result
+        return False
+    return CloudflareDNSIndex(zone).exists(f"{domain}.{zone.name}")
 
 
 def create_cloudflare_dns_entry(zone: CloudflareZone, domain: str, ip_address: str) -> str:
     settings = AppSettings.load()
     if settings.sandbox_mode:
         return ""
-    client = Cloudflare(api_token=settings.cloudflare_api_token)
+    client = get_cloudflare_client()
     domain = f"{domain}.{zone.name}"
-    dns_records = get_cloudflare_dns_records(zone)
-    if domain in [record.name for record in dns_records]:
+    index = CloudflareDNSIndex(zone)
+    if index.exists(domain):
         raise ValueError("DNS record already exists")
-    res = client.dns.records.create(zone_id=zone.cloudflare_id, name=domain,
-                                    type="A", content=ip_address, ttl=1)
+    with provider_slot(CLOUDFLARE), external_call(CLOUDFLARE, "create_dns_record"):
+        res = client.dns.records.create(zone_id=zone.cloudflare_id, name=domain,
+                                        type="A", content=ip_address, ttl=1)
+    index.add(domain, res.id)
     return res.id
 
 
-def delete_cloudflare_dns_entry(zone: CloudflareZone, dns_record_id: str) -> str:
+def delete_cloudflare_dns_entry(zone: CloudflareZone, dns_record_id: str, domain: str | None = None) -> str:
     settings = AppSettings.load()
     if settings.sandbox_mode or not dns_record_id:
         return ""
-    client = Cloudflare(api_token=settings.cloudflare_api_token)
-    res = client.dns.records.delete(zone_id=zone.cloudflare_id, dns_record_id=dns_record_id)
+    client = get_cloudflare_client()
+    with provider_slot(CLOUDFLARE), external_call(CLOUDFLARE, "delete_dns_record"):
+        res = client.dns.records.delete(zone_id=zone.cloudflare_id, dns_record_id=dns_record_id)
+    if domain:
+        CloudflareDNSIndex(zone).remove(f"{domain}.{zone.name}")
     return res.id
 
 
-def update_upcloud_zones():
+def delete_cloudflare_dns_entries(zone: CloudflareZone, records: dict[str, str]) -> None:
+    """Deletes the record id -> domain pairs of one zone with a single batch call"""
     settings = AppSettings.load()
-    if settings.sandbox_mode:
+    if settings.sandbox_mode or not records:
         return
-    url = settings.upcloud_api_url + "/1.3/zone"
-    res = requests.get(url, auth=get_upcloud_auth()).json()
-    upcloud_zone_names = [x.get("id") for x in res.get("zones").get("zone")]
-    existing_zone_names = set(UpCloudZone.objects.values_list("name", flat=True))
-    bulk_zones = []
-    for zone in upcloud_zone_names:
-        if zone not in existing_zone_names:
-            bulk_zones.append(UpCloudZone(name=zone))
-    UpCloudZone.objects.bulk_create(bulk_zones)
-
-    zones_to_delete = existing_zone_names - set(upcloud_zone_names)
-    if zones_to_delete:
-        UpCloudZone.objects.filter(name__in=zones_to_delete).update(visible=False)
-
-
-def create_upcloud_server(request: Request) -> (tuple[str, str]):
-    settings = AppSettings.load()
-    if settings.sandbox_mode:
-        return "", ""
+    client = get_cloudflare_client()
+    with provider_slot(CLOUDFLARE), external_call(CLOUDFLARE, "delete_dns_records"):
+        client.dns.records.batch(zone_id=zone.cloudflare_id, deletes=[{"id": record_id} for record_id in records])
+    index = CloudflareDNSIndex(zone)
+    for domain in records.values():
+        index.remove(f"{domain}.{zone.name}")
+
+
+def update_upcloud_zones():
+    sync_catalog(CatalogSync.Catalog.UPCLOUD_ZONES)
 
-    def make_payload():
-        payload = deepcopy(BASE_UPCLOUD_PAYLOAD)
-        payload["server"]["zone"] = request.upcloud_zone.name
-        payload["server"]["title"] = request.domain + "." + request.cloudflare_zone.name
-        payload["server"]["hostname"] = request.domain + "." + request.cloudflare_zone.name
-        payload["server"]["plan"] = request.upcloud_plan.name
-        payload["server"]["user_data"] = get_init_script(request)
-        payload["server"]["login_user"]["ssh_keys"]["ssh_key"] = list(
-            SSHKeys.objects.values_list("public_key", flat=True))
-        return payload
 
+def update_upcloud_plans():
+    sync_catalog(CatalogSync.Catalog.UPCLOUD_PLANS)
+
+
+def make_upcloud_server_payload(request: Request, init_script: str, ssh_keys: list[str]) -> dict:
     if not request.upcloud_zone.name or not request.cloudflare_zone or not request.domain or not request.upcloud_plan:
         raise ValueError("Zone or Plan not set")
-
-    if not SSHKeys.objects.count():
+    if not ssh_keys:
         raise ValueError("No SSH keys available")
 
-    url = settings.upcloud_api_url + "/1.3/server"
-
-    res = requests.post(url, auth=get_upcloud_auth(), json=make_payload()).json()
-    request.upcloud_server_id = res["server"]["uuid"]
-    request.upcloud_server_address = res["server"]["ip_addresses"]["ip_address"][0]["address"]
+    payload = deepcopy(BASE_UPCLOUD_PAYLOAD)
+    payload["server"]["zone"] = request.upcloud_zone.name
+    payload["server"]["title"] = request.domain + "." + request.cloudflare_zone.name
+    payload["server"]["hostname"] = request.domain + "." + request.cloudflare_zone.name
+    payload["server"]["plan"] = request.upcloud_plan.name
+    payload["server"]["user_data"] = render_init_script(init_script, request)
+    payload["server"]["login_user"]["ssh_keys"]["ssh_key"] = ssh_keys
+    return payload
+
+
+def _closing_db_connections(func):
+    """Runs func in a pool thread and closes the database connection Django may have opened for that thread"""
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        finally:
+            connections.close_all()
+
+    return wrapper
+
+
+def prepare_upcloud_server(request: Request, check_dns: bool = True) -> dict:
+    """
+    Returns the payload for creating the server of `request`. The DNS availability check and the init
+    script download run in threads while the SSH keys are read, so preparing takes as long as the slowest
+    of them instead of their sum. Raises ValueError if the domain is taken or the request is incomplete.
+    """
+    name = f"{request.domain}.{request.cloudflare_zone.name}"
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        dns_taken = executor.submit(_closing_db_connections(CloudflareDNSIndex(request.cloudflare_zone).exists),
+                                    name) if check_dns else None
+        init_script = executor.submit(_closing_db_connections(fetch_init_script))
+        ssh_keys = list(SSHKeys.objects.values_list("public_key", flat=True))
+        if dns_taken and dns_taken.result():
+            raise ValueError(f"Domain {name} already exists")
+        return make_upcloud_server_payload(request, init_script.result(), ssh_keys)
+
+
+def _save_created_server(request: Request, server: dict) -> tuple[str, str]:
+    request.upcloud_server_id = server["uuid"]
+    request.upcloud_server_address = server["ip_addresses"]["ip_address"][0]["address"]
     request.activated = timezone.now()
     request.save()
     return request.upcloud_server_id, request.upcloud_server_address
 
 
+def create_upcloud_server(request: Request, check_dns: bool = False) -> (tuple[str, str]):
+    settings = AppSettings.load()
+    if settings.sandbox_mode:
+        return "", ""
+
+    payload = prepare_upcloud_server(request, check_dns)
+    with provider_slot(UPCLOUD), external_call(UPCLOUD, "create_server") as call:
+        res = get_upcloud_client().post("/1.3/server", json=payload)
+        call.record_status(res.status_code)
+    res.raise_for_status()
+    return _save_created_server(request, res.json()["server"])
+
+
 def stop_upcloud_server(request: Request) -> int:
     settings = AppSettings.load()
     if settings.sandbox_mode:
         return
-    url = settings.upcloud_api_url + f"/1.3/server/{request.upcloud_server_id}/stop"
-    res = requests.post(url, auth=get_upcloud_auth())
+    with provider_slot(UPCLOUD), external_call(UPCLOUD, "stop_server") as call:
+        res = get_upcloud_client().post(f"/1.3/server/{request.upcloud_server_id}/stop")
+        call.record_status(res.status_code)
     return res.status_code
 
 
+def get_upcloud_server_state(request: Request) -> str | None:
+    """Returns the UpCloud server state (started, stopped, maintenance, error) or None if the server is gone"""
+    settings = AppSettings.load()
+    if settings.sandbox_mode:
+        return "stopped"
+    with external_call(UPCLOUD, "get_server") as call:
+        res = get_upcloud_client().get(f"/1.3/server/{request.upcloud_server_id}")
+        # a server that is gone is an answer, not an error
+        call.record_status(res.status_code, expected=(404,))
+    if res.status_code == 404:
+        return None
+    res.raise_for_status()
+    return res.json()["server"]["state"]
+
+
 def delete_upcloud_server(request: Request) -> int:
+    """Deletes the server with its storages and returns the status code, the caller records the deactivation"""
     settings = AppSettings.load()
     if settings.sandbox_mode:
         return
-    url = settings.upcloud_api_url + f"/1.3/server/{request.upcloud_server_id}?storages=1&backups=delete"
-    res = requests.delete(url, auth=get_upcloud_auth())
-    request.deactivated = timezone.now()
-    request.save()
+    with provider_slot(UPCLOUD), external_call(UPCLOUD, "delete_server") as call:
+        res = get_upcloud_client().delete(f"/1.3/server/{request.upcloud_server_id}",
+                                          params={"storages": 1, "backups": "delete"})
+        call.record_status(res.status_code)
     return res.status_code
 
 
-def get_init_script(request: Request) -> str:
+def fetch_init_script(revalidate: bool = False) -> str:
+    """
+    Returns the body of AppSettings.init_script_url. The body is cached and served as is for
+    INIT_SCRIPT_FRESH_FOR seconds, after that it is revalidated with If-None-Match/If-Modified-Since.
+    If the script host fails, the last good copy is served instead.
+    """
     settings = AppSettings.load()
-    if settings.sandbox_mode:
-        return ""
-    res = requests.get(settings.init_script_url)
-    script = res.text
+    url = settings.init_script_url
+    cached = cache.get(INIT_SCRIPT_CACHE_KEY)
+    if cached and cached["url"] != url:
+        cached = None
+    if cached and not revalidate and time.time() - cached["checked"] < INIT_SCRIPT_FRESH_FOR:
+        return cached["body"]
+
+    headers = {}
+    if cached and cached["etag"]:
+        headers["If-None-Match"] = cached["etag"]
+    if cached and cached["last_modified"]:
+        headers["If-Modified-Since"] = cached["last_modified"]
+    try:
+        with external_call(INIT_SCRIPT, "fetch") as call:
+            res = requests.get(url, headers=headers, timeout=INIT_SCRIPT_TIMEOUT)
+            call.record_status(res.status_code)
+        if res.status_code != 304 or not cached:
+            res.raise_for_status()
+    except requests.RequestException as exc:
+        if not cached:
+            raise
+        logger.warning("Serving stale init script, fetching %s failed: %s", url, exc)
+        return cached["body"]
+
+    if res.status_code == 304:
+        cached["checked"] = time.time()
+    else:
+        cached = {
+            "url": url,
+            "body": res.text,
+            "etag": res.headers.get("ETag"),
+            "last_modified": res.headers.get("Last-Modified"),
+            "checked": time.time(),
+        }
+    cache.set(INIT_SCRIPT_CACHE_KEY, cached, timeout=None)
+    return cached["body"]
+
+
+def render_init_script(script: str, request: Request) -> str:
     domain = f"{request.domain}.{request.cloudflare_zone.name}"
     script = script.replace("$IP", domain)
     script += "\ncd /opt/\n"
@@ -189,6 +338,13 @@ def get_init_script(request: Request) -> str:
     return script
 
 
+def get_init_script(request: Request) -> str:
+    settings = AppSettings.load()
+    if settings.sandbox_mode:
+        return ""
+    return render_init_script(fetch_init_script(), request)
+
+
 def duplicate_request(request: Request) -> Request:
     data = {
         "party_name": request.party_name,
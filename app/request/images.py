@@ -0,0 +1,57 @@
+import hashlib
+import os
+from io import BytesIO
+
+from PIL import Image, ImageOps, features
+
+from django.core.files.base import ContentFile
+
+# Widths of the responsive derivatives, the landing page grid shows the images at most 960 px wide
+DERIVATIVE_WIDTHS = (480, 960, 1440)
+# Best format first, formats the installed Pillow cannot write are skipped
+DERIVATIVE_FORMATS = {
+    "avif": {"quality": 60},
+    "webp": {"quality": 80, "method": 6},
+}
+DERIVATIVE_DIR = "derivatives"
+
+
+def generate_image_derivatives(image) -> dict:
+    """
+    Writes resized AVIF/WebP copies of `image` (an ImageField value) next to it in the same storage, named by a hash
+    of their content so they can be cached forever. Returns the description stored in PortfolioItem.image_derivatives.
+    """
+    with image.open("rb") as f:
+        original = Image.open(f)
+        original = ImageOps.exif_transpose(original)
+        original = original.convert("RGBA" if original.mode in ("RGBA", "LA", "P") else "RGB")
+
+    # Never upscale, the original width is the largest derivative of a small upload
+    widths = sorted({min(width, original.width) for width in DERIVATIVE_WIDTHS})
+    stem = os.path.splitext(os.path.basename(image.name))[0]
+    formats = {}
+    for fmt, options in DERIVATIVE_FORMATS.items():
+        if not features.check(fmt):
+            continue
+        formats[fmt] = []
+        for width in widths:
+            height = round(original.height * width / original.width)
+            buffer = BytesIO()
+            original.resize((width, height), Image.Resampling.LANCZOS).save(buffer, format=fmt.upper(), **options)
+            content = buffer.getvalue()
+            digest = hashlib.sha256(content).hexdigest()[:16]
+            name = f"{DERIVATIVE_DIR}/{stem}-{width}w.{digest}.{fmt}"
+            if not image.storage.exists(name):
+                name = image.storage.save(name, ContentFile(content))
+            formats[fmt].append({"width": width, "name": name})
+
+    return {"source": image.name, "formats": formats}
+
+
+def delete_image_derivatives(storage, derivatives: dict, keep: dict | None = None) -> None:
+    """Removes the files of an image_derivatives description from `storage`, except those also listed in `keep`"""
+    kept = {d["name"] for formats in (keep or {}).get("formats", {}).values() for d in formats}
+    for formats in derivatives.get("formats", {}).values():
+        for derivative in formats:
+            if derivative["name"] not in kept:
+                storage.delete(derivative["name"])
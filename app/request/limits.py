@@ -0,0 +1,47 @@
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from dramatiq.rate_limits import ConcurrentRateLimiter
+from dramatiq.rate_limits.backends import RedisBackend, StubBackend
+
+UPCLOUD = "upcloud"
+CLOUDFLARE = "cloudflare"
+
+# Seconds a provider call waits for a free slot before giving up, the Retries middleware tries the step again
+SLOT_WAIT = 60
+# Milliseconds after which the slot of a worker that died mid call is given back
+SLOT_TTL = 5 * 60_000
+
+_backend = None
+
+
+class ProviderBusy(Exception):
+    """No free slot for the provider within SLOT_WAIT seconds"""
+
+
+def get_limiter_backend():
+    global _backend
+    if _backend is None:
+        url = settings.PROVIDER_LIMITER_URL
+        _backend = RedisBackend(url=url) if url else StubBackend()
+    return _backend
+
+
+@contextmanager
+def provider_slot(provider: str):
+    """
+    Holds one of the PROVIDER_CONCURRENCY[provider] slots shared by every worker process while the block runs,
+    so a bulk action fanned out over many workers does not hit a provider with more calls than it allows.
+    """
+    limiter = ConcurrentRateLimiter(get_limiter_backend(), f"provider-slots:{provider}",
+                                    limit=settings.PROVIDER_CONCURRENCY[provider], ttl=SLOT_TTL)
+    deadline = time.monotonic() + SLOT_WAIT
+    while True:
+        with limiter.acquire(raise_on_failure=False) as acquired:
+            if acquired:
+                yield
+                return
+        if time.monotonic() > deadline:
+            raise ProviderBusy(f"All {settings.PROVIDER_CONCURRENCY[provider]} {provider} slots are in use")
+        time.sleep(0.5)
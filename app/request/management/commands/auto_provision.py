@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from request.tasks import run_auto_provisioning
+
+
+class Command(BaseCommand):
+    help = "Activate approved requests whose inception date has arrived and tear down requests after party_end"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--dry-run", action="store_true", help="Only list what would be activated and torn down")
+
+    def handle(self, *args, dry_run, **options):
+        plan = run_auto_provisioning(dry_run=dry_run)
+        for action, requests in plan.items():
+            for request in requests:
+                self.stdout.write(f"{action}: {request} ({request.domain}, "
+                                  f"inception {request.inception_date}, ends {request.party_end})")
+        prefix = "Would queue" if dry_run else "Queued"
+        self.stdout.write(f"{prefix} {len(plan['teardown'])} teardown(s) and {len(plan['activate'])} activation(s)")
@@ -0,0 +1,96 @@
+import random
+import time
+from datetime import date, datetime, time as datetime_time, timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.utils import timezone
+
+from request.models import CloudflareZone, Request
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = ("Fill the request table with synthetic rows inside a transaction that is rolled back, and print "
+            "query plans and timings for the activation and scheduling queries with and without the indexes")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rows", type=int, default=100_000)
+        parser.add_argument("--repeat", type=int, default=20)
+
+    def handle(self, *args, rows, repeat, **options):
+        try:
+            with transaction.atomic():
+                self.populate(rows)
+                self.run_queries(repeat, "with indexes")
+                with connection.cursor() as cursor:
+                    for index in Request._meta.indexes:
+                        cursor.execute(f"DROP INDEX {connection.ops.quote_name(index.name)}")
+                self.run_queries(repeat, "without indexes")
+                raise Rollback
+        except Rollback:
+            pass
+
+    def populate(self, rows):
+        zone = CloudflareZone.objects.create(name="benchmark.invalid", cloudflare_id="benchmark")
+        now = timezone.now()
+        today = date.today()
+        batch = []
+        for i in range(rows):
+            party_start = today - timedelta(days=random.randint(-60, 3650))
+            activated = deactivated = None
+            if party_start < today - timedelta(days=7):
+                activated = timezone.make_aware(datetime.combine(party_start - timedelta(days=2), datetime_time()))
+                deactivated = activated + timedelta(days=random.randint(3, 10))
+            elif random.random() < 0.3:
+                # the handful of parties that are running right now
+                activated = now - timedelta(days=random.randint(0, 5))
+            batch.append(Request(
+                party_name=f"Benchmark {i}",
+                contact_email="benchmark@example.com",
+                party_start=party_start,
+                party_end=party_start + timedelta(days=2),
+                inception_date=party_start - timedelta(days=2),
+                domain=f"benchmark{i}",
+                cloudflare_zone=zone,
+                is_approved=activated is not None or random.random() < 0.5,
+                activated=activated,
+                deactivated=deactivated,
+            ))
+        Request.objects.bulk_create(batch, batch_size=2000)
+        with connection.cursor() as cursor:
+            cursor.execute("ANALYZE")
+        self.stdout.write(f"Inserted {rows} synthetic requests")
+
+    def queries(self):
+        today = date.today()
+        return {
+            "activation list, first page": Request.objects.order_by("is_inactive", "-party_start", "-pk")[:51],
+            "currently active": Request.objects.filter(activated__isnull=False, deactivated__isnull=True),
+            "pending inception": Request.objects.filter(is_approved=True, activated__isnull=True,
+                                                        inception_date__lte=today),
+            "admin party_start filter": Request.objects.filter(party_start__year=today.year),
+            "activated, for statistics": Request.objects.filter(activated__isnull=False)
+            .values_list("activated", "deactivated"),
+        }
+
+    def run_queries(self, repeat, label):
+        self.stdout.write(self.style.MIGRATE_HEADING(f"\n{label}"))
+        for name, queryset in self.queries().items():
+            started = time.perf_counter()
+            for _ in range(repeat):
+                count = len(queryset.all())
+            elapsed = (time.perf_counter() - started) / repeat * 1000
+            self.stdout.write(self.style.SUCCESS(f"{name}: {count} row(s), {elapsed:.2f} ms"))
+            self.stdout.write(self.explain(queryset, label))
+
+    def explain(self, queryset, label):
+        # The label comment changes the statement text, otherwise SQLite reuses the cached plan from before
+        # the indexes were dropped
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute(f"{connection.ops.explain_query_prefix()} {sql} -- {label}", params)
+            return "\n".join(" ".join(str(column) for column in row) for row in cursor.fetchall())
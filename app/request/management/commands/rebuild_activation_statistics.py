@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from request.statistics import rebuild_activation_statistics
+
+
+class Command(BaseCommand):
+    help = "Recompute the activation statistics shown on the activation list from all requests"
+
+    def handle(self, *args, **options):
+        count = rebuild_activation_statistics()
+        self.stdout.write(f"Wrote {count} activation statistic(s)")
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from request.reconcile import reconcile
+
+
+class Command(BaseCommand):
+    help = ("Compare the server and DNS record ids stored on requests with UpCloud and Cloudflare and report "
+            "orphaned and missing resources")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--fix", action="store_true",
+                            help="Deprovision orphaned servers, delete orphaned DNS records and recreate missing ones")
+
+    def handle(self, *args, fix, **options):
+        drift = reconcile(fix=fix)
+        for finding in drift:
+            self.stdout.write(str(finding))
+        self.stdout.write(f"{len(drift)} finding(s)" + (", fixes applied" if fix and drift else ""))
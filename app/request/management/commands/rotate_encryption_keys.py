@@ -0,0 +1,46 @@
+from django.apps import apps
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from request import models
+from request.models import EncryptedValue, FernetEncryptedCharField, SingletonModel
+
+
+class Command(BaseCommand):
+    help = "Re-encrypt every FernetEncryptedCharField value with the current FERNET_ENCRYPTION_KEY"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=500)
+
+    def handle(self, *args, batch_size, **options):
+        for model in apps.get_models():
+            fields = [field.attname for field in model._meta.concrete_fields
+                      if isinstance(field, FernetEncryptedCharField)]
+            if not fields:
+                continue
+
+            # Ciphertext is streamed as is (from_db_value does not decrypt) and rotated without the plaintext
+            # ever being loaded on a model instance
+            rows = model._base_manager.order_by("pk").values_list("pk", *fields).iterator(chunk_size=batch_size)
+            count = 0
+            batch = []
+            for row in rows:
+                batch.append(row)
+                if len(batch) >= batch_size:
+                    count += self.rotate_batch(model, fields, batch)
+                    batch = []
+            count += self.rotate_batch(model, fields, batch)
+
+            if issubclass(model, SingletonModel):
+                for obj in model._base_manager.all():
+                    obj.set_cache()
+            self.stdout.write(f"{model._meta.label}: re-encrypted {count} row(s)")
+
+    def rotate_batch(self, model, fields, batch):
+        with transaction.atomic():
+            for pk, *values in batch:
+                model._base_manager.filter(pk=pk).update(**{
+                    field: EncryptedValue(models.fernet.rotate(value.encode()).decode())
+                    for field, value in zip(fields, values) if value is not None
+                })
+        return len(batch)
@@ -0,0 +1,23 @@
+import signal
+
+from django.core.management.base import BaseCommand
+
+from request.scheduler import PERIODIC_JOBS, Scheduler
+
+
+class Command(BaseCommand):
+    help = "Enqueue the periodic Dramatiq jobs in request/scheduler.py when they are due, runs until stopped"
+
+    def handle(self, *args, **options):
+        stopping = False
+
+        def stop(signum, frame):
+            nonlocal stopping
+            stopping = True
+
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+
+        for job in PERIODIC_JOBS:
+            self.stdout.write(f"{job.name}: every {job.interval}")
+        Scheduler().run(should_stop=lambda: stopping)
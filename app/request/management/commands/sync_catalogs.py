@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from request.tasks import sync_catalogs
+
+
+class Command(BaseCommand):
+    help = "Queue a sync of the Cloudflare zones, UpCloud zones and UpCloud plans, or run it right away with --now"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--now", action="store_true", help="Sync in this process instead of a worker")
+
+    def handle(self, *args, now, **options):
+        if now:
+            sync_catalogs()
+            self.stdout.write("Catalogs synced")
+        else:
+            sync_catalogs.send()
+            self.stdout.write("Catalog sync queued")
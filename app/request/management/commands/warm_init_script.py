@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from request.helpers import fetch_init_script
+
+
+class Command(BaseCommand):
+    help = "Fetch the server init script into the cache so activations do not have to download it"
+
+    def handle(self, *args, **options):
+        script = fetch_init_script(revalidate=True)
+        self.stdout.write(f"Cached init script, {len(script)} characters")
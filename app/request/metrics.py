@@ -0,0 +1,166 @@
+import logging
+import os
+import time
+
+import dramatiq
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from dramatiq.middleware import Middleware
+from prometheus_client import CollectorRegistry, Counter, Histogram, REGISTRY
+from prometheus_client.core import GaugeMetricFamily
+from prometheus_client.multiprocess import MultiProcessCollector
+from redis import RedisError
+
+logger = logging.getLogger(__name__)
+
+MAILJET = "mailjet"
+TURNSTILE = "turnstile"
+INIT_SCRIPT = "init_script"
+DRAMATIQ = "dramatiq"
+
+# Server creation and deletion take seconds, DNS lookups and the Turnstile check tens of milliseconds
+EXTERNAL_CALL_BUCKETS = (0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60)
+ACTOR_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+VIEW_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Only counters and histograms are used: prometheus_client multiprocess mode sums them over the files of every
+# process, including processes that have exited, so nothing is lost when gunicorn or Dramatiq replace a worker
+EXTERNAL_CALL_SECONDS = Histogram("partyman_external_call_seconds", "Duration of calls to external services",
+                                  ["service", "operation"], buckets=EXTERNAL_CALL_BUCKETS)
+EXTERNAL_CALL_ERRORS = Counter("partyman_external_call_errors", "Calls to external services that failed",
+                               ["service", "operation", "error"])
+ACTOR_SECONDS = Histogram("partyman_actor_seconds", "Duration of Dramatiq messages by actor and outcome",
+                          ["actor", "outcome"], buckets=ACTOR_BUCKETS)
+ACTOR_ERRORS = Counter("partyman_actor_errors", "Dramatiq messages that raised", ["actor", "error"])
+VIEW_SECONDS = Histogram("partyman_view_seconds", "Duration of requests by view, method and status code",
+                         ["view", "method", "status"], buckets=VIEW_BUCKETS)
+
+
+class external_call:
+    """
+    Times one call to an external service into EXTERNAL_CALL_SECONDS and counts it in EXTERNAL_CALL_ERRORS when
+    it raises (labelled with the exception class) or when record_status() is given an error status code.
+    An error recorded by record_status() or record_error() wins over the class of the exception it leads to.
+    Waiting for a provider_slot is not part of the call, open the slot first.
+    """
+
+    def __init__(self, service: str, operation: str):
+        self.service = service
+        self.operation = operation
+        self.error = None
+
+    def record_error(self, error: str) -> None:
+        self.error = error
+
+    def record_status(self, status_code: int | None, expected: tuple[int, ...] = ()) -> None:
+        """Counts an error status code unless it is one of the `expected` answers"""
+        if status_code in expected:
+            return
+        if status_code is None or status_code >= 400:
+            self.record_error(f"http_{status_code}" if status_code else "no_response")
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        EXTERNAL_CALL_SECONDS.labels(self.service, self.operation).observe(time.perf_counter() - self.started)
+        error = self.error or (exc_type.__name__ if exc_type else None)
+        if error:
+            EXTERNAL_CALL_ERRORS.labels(self.service, self.operation, error).inc()
+        return False
+
+
+class ActorMetrics(Middleware):
+    """Dramatiq middleware timing every message into ACTOR_SECONDS, retries are timed as separate messages"""
+
+    def __init__(self):
+        self.started = {}
+
+    def before_process_message(self, broker, message):
+        self.started[message.message_id] = time.perf_counter()
+
+    def after_process_message(self, broker, message, *, result=None, exception=None):
+        started = self.started.pop(message.message_id, None)
+        if started is None:
+            return
+        outcome = "failed" if exception else "succeeded"
+        ACTOR_SECONDS.labels(message.actor_name, outcome).observe(time.perf_counter() - started)
+        if exception:
+            ACTOR_ERRORS.labels(message.actor_name, type(exception).__name__).inc()
+
+    def after_skip_message(self, broker, message):
+        self.started.pop(message.message_id, None)
+
+
+def view_metrics_middleware(get_response):
+    """Times every request into VIEW_SECONDS, labelled with the URL name so that ids in paths do not add series"""
+
+    def observe(request, started, response):
+        match = request.resolver_match
+        view = match.view_name if match else "unresolved"
+        VIEW_SECONDS.labels(view, request.method, response.status_code).observe(time.perf_counter() - started)
+
+    if iscoroutinefunction(get_response):
+        async def middleware(request):
+            started = time.perf_counter()
+            response = await get_response(request)
+            observe(request, started, response)
+            return response
+
+        return markcoroutinefunction(middleware)
+
+    def middleware(request):
+        started = time.perf_counter()
+        response = get_response(request)
+        observe(request, started, response)
+        return response
+
+    return middleware
+
+
+view_metrics_middleware.sync_capable = True
+view_metrics_middleware.async_capable = True
+
+
+class QueueDepthCollector:
+    """
+    Messages in every Dramatiq queue, read from Redis when /metrics is scraped. Counts the messages that have
+    not been acked yet (waiting and in progress) of each queue, its delay queue and its dead letter queue.
+    """
+
+    def collect(self):
+        broker = dramatiq.get_broker()
+        client = getattr(broker, "client", None)
+        if client is None:
+            return
+        queues = sorted(broker.get_declared_queues() | broker.get_declared_delay_queues())
+        queues += [f"{queue}.XQ" for queue in sorted(broker.get_declared_queues())]
+        pipe = client.pipeline(transaction=False)
+        for queue in queues:
+            pipe.hlen(f"{broker.namespace}:{queue}.msgs")
+        try:
+            sizes = pipe.execute()
+        except RedisError as exc:
+            logger.warning("Could not read the Dramatiq queue sizes: %s", exc)
+            return
+        gauge = GaugeMetricFamily("partyman_dramatiq_queue_messages", "Messages in a Dramatiq queue", labels=["queue"])
+        for queue, size in zip(queues, sizes):
+            gauge.add_metric([queue], size)
+        yield gauge
+
+
+def build_registry(multiproc_dirs: list[str]) -> CollectorRegistry:
+    """
+    The registry served by /metrics. With multiproc_dirs the samples written by every gunicorn and Dramatiq
+    process are summed, otherwise (runserver, tests) this process' default registry is served as is.
+    A directory that does not exist yet, of a container that has not started, is skipped.
+    """
+    registry = CollectorRegistry()
+    if multiproc_dirs:
+        for path in multiproc_dirs:
+            if os.path.isdir(path):
+                MultiProcessCollector(registry, path=path)
+    else:
+        registry.register(REGISTRY)
+    registry.register(QueueDepthCollector())
+    return registry
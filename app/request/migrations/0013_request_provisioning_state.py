@@ -0,0 +1,23 @@
+# Generated by Django 5.2.10 on 2026-10-18 16:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('request', '0012_appsettings'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='request',
+            name='provisioning_error',
+            field=models.TextField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='request',
+            name='provisioning_state',
+            field=models.CharField(blank=True, choices=[('', 'Not started'), ('queued', 'Queued'), ('validating', 'Validating domain'), ('creating_server', 'Creating server'), ('creating_dns', 'Creating DNS record'), ('sending_mail', 'Sending activation email'), ('active', 'Active'), ('failed', 'Failed')], default='', max_length=32),
+        ),
+    ]
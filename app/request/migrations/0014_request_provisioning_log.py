@@ -0,0 +1,23 @@
+# Generated by Django 5.2.10 on 2026-10-18 16:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('request', '0013_request_provisioning_state'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='request',
+            name='provisioning_log',
+            field=models.JSONField(blank=True, default=list),
+        ),
+        migrations.AlterField(
+            model_name='request',
+            name='provisioning_state',
+            field=models.CharField(blank=True, choices=[('', 'Not started'), ('queued', 'Queued'), ('validating', 'Validating domain'), ('creating_server', 'Creating server'), ('creating_dns', 'Creating DNS record'), ('sending_mail', 'Sending activation email'), ('active', 'Active'), ('deprovisioning', 'Deprovisioning'), ('stopping_server', 'Stopping server'), ('deleting_dns', 'Deleting DNS record'), ('deleting_server', 'Deleting server'), ('deactivated', 'Deactivated'), ('failed', 'Failed')], default='', max_length=32),
+        ),
+    ]
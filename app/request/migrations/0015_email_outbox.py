@@ -0,0 +1,32 @@
+# Generated by Django 5.2.10 on 2026-10-18 16:05
+
+from django.db import migrations, models
+from django.db.models import F
+
+
+def mark_existing_emails_delivered(apps, schema_editor):
+    # Emails created before the outbox were sent right away, they must not be queued again
+    Email = apps.get_model('request', 'Email')
+    Email.objects.filter(delivery_status_code=200).update(status='sent', sent=F('created'))
+    Email.objects.exclude(delivery_status_code=200).update(status='failed')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('request', '0014_request_provisioning_log'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='email',
+            name='sent',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='email',
+            name='status',
+            field=models.CharField(choices=[('queued', 'Queued'), ('sending', 'Sending'), ('sent', 'Sent'), ('failed', 'Failed')], default='queued', max_length=16),
+        ),
+        migrations.RunPython(mark_existing_emails_delivered, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.10 on 2026-10-18 16:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('request', '0015_email_outbox'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='portfolioitem',
+            name='image_derivatives',
+            field=models.JSONField(blank=True, default=dict, editable=False),
+        ),
+    ]
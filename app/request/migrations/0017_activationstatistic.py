@@ -0,0 +1,26 @@
+# Generated by Django 5.2.10 on 2026-10-18 16:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('request', '0016_portfolioitem_image_derivatives'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ActivationStatistic',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('zone', 'Zone'), ('plan', 'Plan'), ('duration', 'Duration')], max_length=16)),
+                ('name', models.CharField(blank=True, default='', max_length=255)),
+                ('count', models.IntegerField(default=0)),
+                ('total_seconds', models.FloatField(default=0)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('kind', 'name'), name='unique_activation_statistic')],
+            },
+        ),
+    ]
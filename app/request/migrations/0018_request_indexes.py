@@ -0,0 +1,44 @@
+# Generated by Django 5.2.10 on 2026-10-18 16:12
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('request', '0017_activationstatistic'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='request',
+            name='is_inactive',
+            field=models.GeneratedField(db_persist=True, expression=models.Case(models.When(activated__isnull=False, deactivated__isnull=True, then=models.Value(0)), default=models.Value(1)), output_field=models.IntegerField()),
+        ),
+        migrations.AddIndex(
+            model_name='request',
+            index=models.Index(fields=['is_inactive', '-party_start', '-id'], name='request_activation_order'),
+        ),
+        migrations.AddIndex(
+            model_name='request',
+            index=models.Index(condition=models.Q(('activated__isnull', False), ('deactivated__isnull', True)), fields=['party_start'], name='request_active'),
+        ),
+        migrations.AddIndex(
+            model_name='request',
+            index=models.Index(condition=models.Q(('activated__isnull', True), ('is_approved', True)), fields=['inception_date'], name='request_pending_inception'),
+        ),
+        migrations.AddIndex(
+            model_name='request',
+            index=models.Index(fields=['party_start', 'party_end'], name='request_party_dates'),
+        ),
+        migrations.AddIndex(
+            model_name='request',
+            index=models.Index(fields=['activated', 'deactivated'], name='request_activation_dates'),
+        ),
+        migrations.AddIndex(
+            model_name='request',
+            index=models.Index(fields=['created'], name='request_created'),
+        ),
+    ]
@@ -0,0 +1,46 @@
+# Generated by Django 5.2.10 on 2026-10-18 16:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('request', '0018_request_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cloudflarezone',
+            name='missing_since',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='upcloudplan',
+            name='missing_since',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='upcloudzone',
+            name='missing_since',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.CreateModel(
+            name='CatalogSync',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('catalog', models.CharField(choices=[('cloudflare_zones', 'Cloudflare zones'), ('upcloud_zones', 'UpCloud zones'), ('upcloud_plans', 'UpCloud plans')], max_length=32)),
+                ('started', models.DateTimeField()),
+                ('duration', models.FloatField(help_text='Seconds')),
+                ('created', models.IntegerField(default=0)),
+                ('renamed', models.IntegerField(default=0)),
+                ('hidden', models.IntegerField(default=0)),
+                ('unhidden', models.IntegerField(default=0)),
+                ('error', models.TextField(blank=True, null=True)),
+            ],
+            options={
+                'get_latest_by': 'started',
+                'indexes': [models.Index(fields=['catalog', '-started'], name='catalogsync_latest')],
+            },
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.2.10 on 2026-10-18 16:18
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('request', '0019_catalog_sync'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='request',
+            index=models.Index(condition=models.Q(('activated__isnull', False), ('deactivated__isnull', True)), fields=['party_end'], name='request_active_party_end'),
+        ),
+    ]
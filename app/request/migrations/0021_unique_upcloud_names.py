@@ -0,0 +1,37 @@
+# Generated by Django 5.2.10 on 2026-10-18 16:47
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def merge_duplicate_names(apps, schema_editor):
+    # Requests of a duplicate zone or plan are moved to the oldest row with that name before it is made unique
+    Request = apps.get_model('request', 'Request')
+    for model_name, field in (('UpCloudZone', 'upcloud_zone'), ('UpCloudPlan', 'upcloud_plan')):
+        model = apps.get_model('request', model_name)
+        duplicates = model.objects.values('name').annotate(count=Count('id')).filter(count__gt=1)
+        for name in duplicates.values_list('name', flat=True):
+            keep, *others = model.objects.filter(name=name).order_by('id')
+            Request.objects.filter(**{f'{field}__in': others}).update(**{field: keep})
+            model.objects.filter(pk__in=[other.pk for other in others]).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('request', '0020_request_active_party_end'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_names, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='upcloudplan',
+            name='name',
+            field=models.CharField(max_length=255, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='upcloudzone',
+            name='name',
+            field=models.CharField(max_length=255, unique=True),
+        ),
+    ]
@@ -1,11 +1,16 @@
 import re
-from cryptography.fernet import Fernet, InvalidToken
+from datetime import timedelta
+from uuid import uuid4
+
+from cryptography.fernet import Fernet, MultiFernet
 
 from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.db import models
+from django.db.models.query_utils import DeferredAttribute
 from django.core.exceptions import ValidationError
 from django.core.cache import cache
+from django.utils import timezone
 
 from django_extensions.db.models import TimeStampedModel
 
@@ -17,15 +22,33 @@ def domain_validator(value):
         )
 
 
-fernet = Fernet(settings.FERNET_ENCRYPTION_KEY)
+# Values are encrypted with the first key, the previous keys are only used for decrypting until
+# the rotate_encryption_keys management command has re-encrypted everything
+fernet = MultiFernet([Fernet(key) for key in [settings.FERNET_ENCRYPTION_KEY, *settings.FERNET_PREVIOUS_KEYS]])
 
 
 class SingletonModel(models.Model):
+    """
+    A model with a single row that is cached in two tiers: the unpickled object is kept in process memory
+    and reused as long as the small version key in the shared cache has not changed. Saving bumps the
+    version, so every gunicorn worker and Dramatiq process picks up the change on its next load().
+    """
+
     class Meta:
         abstract = True
 
+    # class name -> (version, object), local to this process
+    _local_cache = {}
+
+    @classmethod
+    def _version_key(cls):
+        return f"{cls.__name__}:version"
+
     def set_cache(self):
-        cache.set(self.__class__.__name__, self)
+        version = uuid4().hex
+        cache.set(self.__class__.__name__, (version, self))
+        cache.set(self._version_key(), version, timeout=None)
+        SingletonModel._local_cache[self.__class__.__name__] = (version, self)
 
     def save(self, **kwargs):
         self.pk = 1
@@ -37,31 +60,63 @@ class SingletonModel(models.Model):
 
     @classmethod
     def load(cls):
-        if cache.get(cls.__name__) is None:
-            try:
-                obj = cls.objects.get(pk=1)
-            except cls.DoesNotExist:
-                return cls.objects.none()
-            obj.set_cache()
-        return cache.get(cls.__name__)
+        version = cache.get(cls._version_key())
+        local = SingletonModel._local_cache.get(cls.__name__)
+        if version is not None and local is not None and local[0] == version:
+            return local[1]
+
+        cached = cache.get(cls.__name__) if version is not None else None
+        if cached is not None and cached[0] == version:
+            SingletonModel._local_cache[cls.__name__] = cached
+            return cached[1]
+
+        try:
+            obj = cls.objects.get(pk=1)
+        except cls.DoesNotExist:
+            return cls.objects.none()
+        obj.set_cache()
+        return obj
+
+
+class EncryptedValue(str):
+    """Ciphertext as loaded from the database, the marker for a value that is already encrypted"""
+
+
+class LazyDecryptedAttribute(DeferredAttribute):
+    """Decrypts the loaded ciphertext on first access and keeps the plaintext on the instance"""
+
+    def __get__(self, instance, cls=None):
+        if instance is None:
+            return self
+        value = super().__get__(instance, cls)
+        if isinstance(value, EncryptedValue):
+            value = fernet.decrypt(value.encode()).decode()
+            instance.__dict__[self.field.attname] = value
+        return value
+
+    def __set__(self, instance, value):
+        # Being a data descriptor makes __get__ run even when the value is in the instance __dict__
+        instance.__dict__[self.field.attname] = value
 
 
 class FernetEncryptedCharField(models.CharField):
-    def get_prep_value(self, value):
-        if value is None:
-            return value
+    descriptor_class = LazyDecryptedAttribute
 
-        # If it's already encrypted, leave it alone
-        try:
-            fernet.decrypt(value.encode())
+    def pre_save(self, model_instance, add):
+        # Read the raw attribute, saving must not decrypt a value that was never accessed
+        if self.attname in model_instance.__dict__:
+            return model_instance.__dict__[self.attname]
+        return super().pre_save(model_instance, add)
+
+    def get_prep_value(self, value):
+        if value is None or isinstance(value, EncryptedValue):
             return value
-        except InvalidToken:
-            return fernet.encrypt(value.encode()).decode()
+        return fernet.encrypt(str(value).encode()).decode()
 
     def from_db_value(self, value, expression, connection):
         if value is None:
             return value
-        return fernet.decrypt(value.encode()).decode()
+        return EncryptedValue(value)
 
 
 class AppSettings(SingletonModel):
@@ -93,6 +148,9 @@ class PortfolioItem(TimeStampedModel):
     image = models.ImageField(blank=True, null=True,
                               help_text="Aspect ratio must be 2.4:1 (example: 960x400px)")
 
+    # resized copies of image, generated by a worker, see images.py
+    image_derivatives = models.JSONField(default=dict, blank=True, editable=False)
+
     url = models.URLField(blank=True, null=True)
     sort_order = models.IntegerField(default=0)
     visible = models.BooleanField(default=True)
@@ -100,6 +158,19 @@ class PortfolioItem(TimeStampedModel):
     def __str__(self):
         return self.heading
 
+    @property
+    def image_derivatives_stale(self):
+        return bool(self.image) and self.image_derivatives.get("source") != self.image.name
+
+    def image_sources(self):
+        """(mime type, srcset) pairs of the image derivatives, best format first"""
+        if not self.image or self.image_derivatives_stale:
+            return []
+        return [
+            (f"image/{fmt}", ", ".join(f"{self.image.storage.url(d['name'])} {d['width']}w" for d in derivatives))
+            for fmt, derivatives in self.image_derivatives["formats"].items() if derivatives
+        ]
+
 
 class ExternalURL(TimeStampedModel):
     portfolio_item = models.ForeignKey(PortfolioItem, on_delete=models.CASCADE, related_name='external_urls')
@@ -116,8 +187,48 @@ class Testimonial(TimeStampedModel):
     visible = models.BooleanField(default=True)
 
 
+class ProvisioningState(models.TextChoices):
+    NOT_STARTED = "", "Not started"
+    QUEUED = "queued", "Queued"
+    VALIDATING = "validating", "Validating domain"
+    CREATING_SERVER = "creating_server", "Creating server"
+    CREATING_DNS = "creating_dns", "Creating DNS record"
+    SENDING_MAIL = "sending_mail", "Sending activation email"
+    ACTIVE = "active", "Active"
+    DEPROVISIONING = "deprovisioning", "Deprovisioning"
+    STOPPING_SERVER = "stopping_server", "Stopping server"
+    DELETING_DNS = "deleting_dns", "Deleting DNS record"
+    DELETING_SERVER = "deleting_server", "Deleting server"
+    DEACTIVATED = "deactivated", "Deactivated"
+    FAILED = "failed", "Failed"
+
+    @classmethod
+    def in_progress(cls):
+        return [cls.QUEUED, cls.VALIDATING, cls.CREATING_SERVER, cls.CREATING_DNS, cls.SENDING_MAIL,
+                cls.DEPROVISIONING, cls.STOPPING_SERVER, cls.DELETING_DNS, cls.DELETING_SERVER]
+
+
 class Request(TimeStampedModel):
-    # a pre_save signal will prepare an email for the requester
+    class Meta(TimeStampedModel.Meta):
+        indexes = [
+            # ActivationListView ordering and keyset pagination
+            models.Index(fields=["is_inactive", "-party_start", "-id"], name="request_activation_order"),
+            # the few requests that currently have a server
+            models.Index(fields=["party_start"], name="request_active",
+                         condition=models.Q(activated__isnull=False, deactivated__isnull=True)),
+            # active requests by end date, for the auto teardown
+            models.Index(fields=["party_end"], name="request_active_party_end",
+                         condition=models.Q(activated__isnull=False, deactivated__isnull=True)),
+            # approved requests waiting for their inception date
+            models.Index(fields=["inception_date"], name="request_pending_inception",
+                         condition=models.Q(is_approved=True, activated__isnull=True)),
+            # admin date filters and activation statistics
+            models.Index(fields=["party_start", "party_end"], name="request_party_dates"),
+            models.Index(fields=["activated", "deactivated"], name="request_activation_dates"),
+            models.Index(fields=["created"], name="request_created"),
+        ]
+
+    # a post_save signal will queue the emails for the requester and the admins
     party_name = models.CharField(max_length=255)
     party_url = models.URLField(blank=True, null=True, help_text="URL to the party's official website")
     contact_email = models.EmailField(help_text="Contact email for the party organizer(s)")
@@ -146,18 +257,87 @@ class Request(TimeStampedModel):
     deactivated = models.DateTimeField(blank=True, null=True)
     deactivated_by = models.ForeignKey(get_user_model(), blank=True, null=True, on_delete=models.SET_NULL,
                                        related_name='deactivations')
+    # updated by the provisioning actors in tasks.py
+    provisioning_state = models.CharField(max_length=32, choices=ProvisioningState.choices, blank=True, default="")
+    provisioning_error = models.TextField(blank=True, null=True)
+    provisioning_log = models.JSONField(default=list, blank=True)
+    # 0 while the request has a server, computed by the database so the activation list can sort and
+    # paginate on an index instead of evaluating the expression for every row
+    is_inactive = models.GeneratedField(
+        expression=models.Case(
+            models.When(activated__isnull=False, deactivated__isnull=True, then=models.Value(0)),
+            default=models.Value(1),
+        ),
+        output_field=models.IntegerField(),
+        db_persist=True,
+    )
+
+    # activated, deactivated, upcloud_zone_id and upcloud_plan_id as they are in the database, statistics.py
+    # compares these to the saved values to update ActivationStatistic
+    _statistics_snapshot = (None, None, None, None)
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance.take_statistics_snapshot()
+        return instance
+
+    def take_statistics_snapshot(self):
+        self._statistics_snapshot = tuple(self.__dict__.get(name) for name in
+                                          ("activated", "deactivated", "upcloud_zone_id", "upcloud_plan_id"))
 
     def __str__(self):
         return f"{self.party_name} ({self.party_start.year})"
 
+    def set_provisioning_state(self, state, error=None):
+        if state != self.provisioning_state or error != self.provisioning_error:
+            self.provisioning_log.append({"state": state, "error": error, "at": timezone.now().isoformat()})
+        self.provisioning_state = state
+        self.provisioning_error = error
+        self.save(update_fields=["provisioning_state", "provisioning_error", "provisioning_log", "modified"])
+
+
+class ActivationStatistic(models.Model):
+    """
+    Requests per zone and plan and the summed duration of finished activations, maintained by the Request signals
+    in signals.py so the activation list does not aggregate the whole request table. Rebuilt from scratch with the rebuild_activation_statistics
+    management command.
+    """
+
+    class Kind(models.TextChoices):
+        ZONE = "zone"
+        PLAN = "plan"
+        DURATION = "duration"
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=["kind", "name"], name="unique_activation_statistic")]
+
+    kind = models.CharField(max_length=16, choices=Kind.choices)
+    # zone or plan name, empty for duration
+    name = models.CharField(max_length=255, blank=True, default="")
+    count = models.IntegerField(default=0)
+    total_seconds = models.FloatField(default=0)
+
+    def __str__(self):
+        return f"{self.kind} {self.name}: {self.count}"
+
+    @property
+    def average_duration(self):
+        if not self.count:
+            return None
+        return timedelta(seconds=self.total_seconds / self.count)
+
 
 class UpCloudZone(TimeStampedModel):
     class Meta:
         verbose_name = "UpCloud Zone"
         verbose_name_plural = "UpCloud Zones"
 
-    name = models.CharField(max_length=255)
+    # the catalog sync matches rows on it
+    name = models.CharField(max_length=255, unique=True)
     visible = models.BooleanField(default=True)
+    # set by the catalog sync when the provider stops listing it, see catalog.py
+    missing_since = models.DateTimeField(blank=True, null=True, editable=False)
 
     def __str__(self):
         return self.name
@@ -168,9 +348,12 @@ class UpCloudPlan(TimeStampedModel):
         verbose_name = "UpCloud Plan"
         verbose_name_plural = "UpCloud Plans"
 
-    name = models.CharField(max_length=255)
+    # the catalog sync matches rows on it
+    name = models.CharField(max_length=255, unique=True)
     description = models.CharField(blank=True, null=True)
     visible = models.BooleanField(default=True)
+    # set by the catalog sync when the provider stops listing it, see catalog.py
+    missing_since = models.DateTimeField(blank=True, null=True, editable=False)
 
     def __str__(self):
         return self.description
@@ -181,11 +364,38 @@ class CloudflareZone(TimeStampedModel):
     cloudflare_id = models.CharField(max_length=255, unique=True)
     public = models.BooleanField(default=False)
     visible = models.BooleanField(default=True)
+    # set by the catalog sync when the provider stops listing it, see catalog.py
+    missing_since = models.DateTimeField(blank=True, null=True, editable=False)
 
     def __str__(self):
         return self.name
 
 
+class CatalogSync(models.Model):
+    """One run of catalog.sync_catalog, kept for the admin to see how fresh the zones and plans are"""
+
+    class Catalog(models.TextChoices):
+        CLOUDFLARE_ZONES = "cloudflare_zones", "Cloudflare zones"
+        UPCLOUD_ZONES = "upcloud_zones", "UpCloud zones"
+        UPCLOUD_PLANS = "upcloud_plans", "UpCloud plans"
+
+    class Meta:
+        get_latest_by = "started"
+        indexes = [models.Index(fields=["catalog", "-started"], name="catalogsync_latest")]
+
+    catalog = models.CharField(max_length=32, choices=Catalog.choices)
+    started = models.DateTimeField()
+    duration = models.FloatField(help_text="Seconds")
+    created = models.IntegerField(default=0)
+    renamed = models.IntegerField(default=0)
+    hidden = models.IntegerField(default=0)
+    unhidden = models.IntegerField(default=0)
+    error = models.TextField(blank=True, null=True)
+
+    def __str__(self):
+        return f"{self.get_catalog_display()} {self.started:%Y-%m-%d %H:%M}"
+
+
 class SSHKeys(TimeStampedModel):
     class Meta:
         verbose_name = "SSH Keys"
@@ -198,11 +408,21 @@ class SSHKeys(TimeStampedModel):
         return self.user
 
 
+class EmailStatus(models.TextChoices):
+    QUEUED = "queued", "Queued"
+    SENDING = "sending", "Sending"
+    SENT = "sent", "Sent"
+    FAILED = "failed", "Failed"
+
+
 class Email(TimeStampedModel):
-    # a pre_save signal will deliver the email and populate status fields
+    # an outbox: a post_save signal queues the send_queued_emails actor, which delivers the email
+    # and populates the status fields
     recipients = models.JSONField()
     subject = models.CharField(max_length=255)
     text_content = models.TextField()
     html_content = models.TextField(blank=True, null=True)
     delivery_status_code = models.IntegerField(blank=True, null=True)
     delivery_status_json = models.JSONField(blank=True, null=True)
+    status = models.CharField(max_length=16, choices=EmailStatus.choices, default=EmailStatus.QUEUED)
+    sent = models.DateTimeField(blank=True, null=True)
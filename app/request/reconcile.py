@@ -0,0 +1,139 @@
+import logging
+from functools import partial
+from typing import NamedTuple
+
+import dramatiq
+from django.db import transaction
+
+from request.clients import get_cloudflare_client, get_upcloud_client
+from request.helpers import DNS_RECORDS_PER_PAGE, create_cloudflare_dns_entry, delete_cloudflare_dns_entry
+from request.limits import CLOUDFLARE, UPCLOUD
+from request.metrics import external_call
+from request.models import AppSettings, CloudflareZone, ProvisioningState, Request
+from request.tasks import deprovision_request
+
+logger = logging.getLogger(__name__)
+
+ORPHAN_SERVER = "orphan server"
+UNKNOWN_SERVER = "unknown server"
+ORPHAN_RECORD = "orphan dns record"
+GHOST_SERVER = "ghost server"
+GHOST_RECORD = "ghost dns record"
+
+
+class Drift(NamedTuple):
+    kind: str
+    # the request the drift was found on, None for servers no request knows about
+    request: Request | None
+    provider_id: str
+    detail: str
+
+    def __str__(self):
+        request = f"request {self.request.pk} ({self.request.domain})" if self.request else "no request"
+        return f"{self.kind}: {self.provider_id}, {request}, {self.detail}"
+
+
+def list_upcloud_servers() -> dict[str, dict]:
+    """uuid -> server for every server on the account, UpCloud returns the whole list in one response"""
+    with external_call(UPCLOUD, "list_servers") as call:
+        res = get_upcloud_client().get("/1.3/server")
+        call.record_status(res.status_code)
+    res.raise_for_status()
+    return {server["uuid"]: server for server in res.json()["servers"]["server"]}
+
+
+def list_a_records(zone: CloudflareZone) -> dict[str, object]:
+    """record id -> A record for one zone, iterating the page follows the pagination"""
+    with external_call(CLOUDFLARE, "list_dns_records"):
+        records = get_cloudflare_client().dns.records.list(zone_id=zone.cloudflare_id, type="A",
+                                                            per_page=DNS_RECORDS_PER_PAGE)
+        return {record.id: record for record in records}
+
+
+def find_drift() -> list[Drift]:
+    """
+    Compares the server and DNS record ids stored on requests with what UpCloud and Cloudflare list.
+    Orphans are resources still existing for requests that have been deactivated, ghosts are active
+    requests whose resources are gone. The providers are called once per catalog, not once per request.
+    Requests with provisioning in progress are skipped, their actors are about to change the same resources.
+    """
+    requests = list(Request.objects.select_related("cloudflare_zone")
+                    .exclude(provisioning_state__in=ProvisioningState.in_progress())
+                    .filter(activated__isnull=False))
+    zones = {request.cloudflare_zone_id: request.cloudflare_zone for request in requests
+             if request.cloudflare_dns_record_id}
+    zone_names = tuple(f".{name}" for name in CloudflareZone.objects.values_list("name", flat=True))
+
+    servers = list_upcloud_servers()
+    records = {}
+    for zone in zones.values():
+        records.update(list_a_records(zone))
+
+    active_servers = {r.upcloud_server_id for r in requests if r.deactivated is None and r.upcloud_server_id}
+    active_records = {r.cloudflare_dns_record_id for r in requests
+                      if r.deactivated is None and r.cloudflare_dns_record_id}
+    known_servers = {r.upcloud_server_id for r in requests if r.upcloud_server_id}
+    drift = []
+
+    for request in requests:
+        server_id, record_id = request.upcloud_server_id, request.cloudflare_dns_record_id
+        if request.deactivated is None:
+            if server_id and server_id not in servers:
+                drift.append(Drift(GHOST_SERVER, request, server_id, "server no longer exists on UpCloud"))
+            elif record_id and record_id not in records:
+                drift.append(Drift(GHOST_RECORD, request, record_id, "DNS record no longer exists on Cloudflare"))
+            continue
+        if server_id in servers and server_id not in active_servers:
+            drift.append(Drift(ORPHAN_SERVER, request, server_id,
+                               f"server is {servers[server_id]['state']} after deactivation"))
+        elif record_id in records and record_id not in active_records:
+            drift.append(Drift(ORPHAN_RECORD, request, record_id,
+                               f"{records[record_id].name} still points to {records[record_id].content}"))
+
+    for server_id, server in servers.items():
+        if server_id not in known_servers and server["hostname"].endswith(zone_names):
+            drift.append(Drift(UNKNOWN_SERVER, None, server_id,
+                               f"{server['hostname']} is {server['state']} and not on any request"))
+    return drift
+
+
+def fix_drift(drift: Drift) -> bool:
+    """
+    Repairs one finding, returns False for findings that are only reported. Servers of deactivated requests
+    are torn down by deprovision_request, a missing DNS record of an active request is created again.
+    An active request that lost its server is only reported, the party may still be going on.
+    """
+    request = drift.request
+    if drift.kind == ORPHAN_SERVER:
+        request.set_provisioning_state(ProvisioningState.DEPROVISIONING, f"Reconciliation: {drift.kind}")
+        transaction.on_commit(partial(deprovision_request.send, request.pk))
+        return True
+    if drift.kind == ORPHAN_RECORD:
+        delete_cloudflare_dns_entry(request.cloudflare_zone, drift.provider_id, request.domain)
+        return True
+    if drift.kind == GHOST_RECORD:
+        request.cloudflare_dns_record_id = create_cloudflare_dns_entry(request.cloudflare_zone, request.domain,
+                                                                       request.upcloud_server_address)
+        request.save(update_fields=["cloudflare_dns_record_id", "modified"])
+        return True
+    return False
+
+
+def reconcile(fix: bool = False) -> list[Drift]:
+    """Finds drift and logs it, repairing what can be repaired when `fix` is set. Does nothing in sandbox mode."""
+    if AppSettings.load().sandbox_mode:
+        return []
+    drift = find_drift()
+    for finding in drift:
+        try:
+            fixed = fix and fix_drift(finding)
+        except Exception:
+            logger.exception("Could not fix %s", finding)
+            continue
+        logger.warning("%s%s", finding, " (fixed)" if fixed else "")
+    return drift
+
+
+@dramatiq.actor(max_retries=0, time_limit=10 * 60_000)
+def reconcile_providers(fix=False):
+    reconcile(fix=fix)
@@ -0,0 +1,97 @@
+import logging
+import time
+from dataclasses import dataclass, field
+from datetime import timedelta
+from uuid import uuid4
+
+import dramatiq
+from django.core.cache import cache
+from django_dramatiq.tasks import delete_old_tasks
+
+from request.reconcile import reconcile_providers
+from request.tasks import auto_provision, send_queued_emails, sync_catalogs
+
+logger = logging.getLogger(__name__)
+
+LEADER_KEY = "scheduler:leader"
+# Seconds the leader lock survives without being renewed, another scheduler takes over after this
+LEADER_TTL = 30
+# Seconds between checks for due jobs
+TICK = 5
+
+
+@dataclass
+class PeriodicJob:
+    name: str
+    actor: dramatiq.Actor
+    interval: timedelta
+    kwargs: dict = field(default_factory=dict)
+
+    @property
+    def last_run_key(self):
+        return f"scheduler:last-run:{self.name}"
+
+
+# Jobs enqueued by the runscheduler management command, the actors themselves run on the Dramatiq workers
+PERIODIC_JOBS = [
+    PeriodicJob("cleanup_dramatiq", delete_old_tasks, timedelta(days=1), {"max_task_age": 60 * 60 * 24}),
+    PeriodicJob("sync_catalogs", sync_catalogs, timedelta(minutes=15)),
+    # the outbox is otherwise only drained when an email is created, this picks up emails left behind by a
+    # failed enqueue, exhausted retries or a worker that died while sending
+    PeriodicJob("send_queued_emails", send_queued_emails, timedelta(minutes=5)),
+    # does nothing unless AUTO_PROVISIONING is on
+    PeriodicJob("auto_provision", auto_provision, timedelta(minutes=15)),
+    # report only, drift is fixed by hand with `manage.py reconcile --fix`
+    PeriodicJob("reconcile_providers", reconcile_providers, timedelta(hours=1)),
+]
+
+
+class Scheduler:
+    """
+    Enqueues PERIODIC_JOBS when they are due. Several schedulers can run at once, only the one holding the
+    leader lock in the cache enqueues anything. The last run of each job is kept in the cache too, so a
+    restart or a new leader continues the schedule instead of running everything again.
+    """
+
+    def __init__(self, jobs=None):
+        self.jobs = PERIODIC_JOBS if jobs is None else jobs
+        self.token = uuid4().hex
+
+    def is_leader(self) -> bool:
+        if cache.add(LEADER_KEY, self.token, LEADER_TTL):
+            logger.info("Scheduler %s is the leader", self.token)
+            return True
+        if cache.get(LEADER_KEY) == self.token:
+            cache.touch(LEADER_KEY, LEADER_TTL)
+            return True
+        return False
+
+    def release(self):
+        if cache.get(LEADER_KEY) == self.token:
+            cache.delete(LEADER_KEY)
+
+    def tick(self, now: float | None = None) -> list[PeriodicJob]:
+        """Enqueues the jobs that are due, returns them"""
+        if not self.is_leader():
+            return []
+        now = time.time() if now is None else now
+        last_runs = cache.get_many([job.last_run_key for job in self.jobs])
+        due = [job for job in self.jobs
+               if now - last_runs.get(job.last_run_key, 0) >= job.interval.total_seconds()]
+        for job in due:
+            try:
+                job.actor.send(**job.kwargs)
+            except Exception:
+                logger.exception("Could not enqueue %s", job.name)
+                continue
+            cache.set(job.last_run_key, now, timeout=None)
+            logger.info("Enqueued %s", job.name)
+        return due
+
+    def run(self, should_stop=lambda: False):
+        try:
+            while not should_stop():
+                self.tick()
+                time.sleep(TICK)
+        finally:
+            self.release()
@@ -1,47 +1,54 @@
-from mailjet_rest import Client
+from functools import partial
 
-from django.db.models.signals import pre_save
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
 
-from request.models import Request, Email, AppSettings
-from request.email import generate_request_received_admin_email, generate_request_received_email
+from request.caching import LANDING_PAGE, bump_version
+from request.metrics import DRAMATIQ, external_call
+from request.statistics import record_request_change
+from request.models import Request, Email, EmailStatus, PortfolioItem, ExternalURL, Testimonial
+from request.tasks import send_queued_emails, send_request_received_emails, generate_portfolio_image_derivatives
 
 
 # This file is imported in apps.py
 
-@receiver(pre_save, sender=Request)
-def prepare_request_received_emails(sender, instance, *args, **kwargs):
-    if instance.pk:
-        return
-
-    generate_request_received_admin_email(instance)
-    generate_request_received_email(instance)
-
-
-@receiver(pre_save, sender=Email)
-def send_email(sender, instance, **kwargs):
-    settings = AppSettings.load()
-    mailjet = Client(auth=(settings.mailjet_api_key, settings.mailjet_api_secret), version='v3.1')
-    if instance.pk:
-        return
-
-    data = {
-        'Messages': [
-            {
-                "From": {
-                    "Email": "partyman@partyman.cloud",
-                    "Name": "PartyMan admins"
-                },
-                "To": [{"Email": x, "Name": x} for x in instance.recipients],
-                "Subject": instance.subject,
-                "TextPart": instance.text_content,
-                "HTMLPart": instance.html_content,
-                "TrackOpens": "disabled"
-            }
-        ]
-    }
-
-    res = mailjet.send.create(data=data)
-    instance.delivery_status_code = res.status_code
-    instance.delivery_status_json = res.json()
-    instance.hold_delivery = False
+@receiver(post_save, sender=Request)
+def prepare_request_received_emails(sender, instance, created, **kwargs):
+    # The emails are rendered by a worker, submitting the request form only inserts the Request
+    if created:
+        transaction.on_commit(partial(send_request_received_emails.send, instance.pk))
+
+
+@receiver(post_save, sender=Request)
+def update_activation_statistics(sender, instance, **kwargs):
+    record_request_change(instance)
+
+
+@receiver(post_delete, sender=Request)
+def remove_activation_statistics(sender, instance, **kwargs):
+    record_request_change(instance, deleted=True)
+
+
+def _enqueue_queued_emails():
+    with external_call(DRAMATIQ, "send_queued_emails"):
+        send_queued_emails.send()
+
+
+@receiver(post_save, sender=Email)
+def send_email(sender, instance, created, **kwargs):
+    if created and instance.status == EmailStatus.QUEUED:
+        transaction.on_commit(_enqueue_queued_emails)
+
+
+@receiver([post_save, post_delete], sender=PortfolioItem)
+@receiver([post_save, post_delete], sender=ExternalURL)
+@receiver([post_save, post_delete], sender=Testimonial)
+def invalidate_landing_page(sender, **kwargs):
+    bump_version(LANDING_PAGE)
+
+
+@receiver(post_save, sender=PortfolioItem)
+def queue_image_derivatives(sender, instance, **kwargs):
+    if instance.image_derivatives_stale:
+        transaction.on_commit(partial(generate_portfolio_image_derivatives.send, instance.pk))
@@ -0,0 +1,82 @@
+from collections import Counter
+
+from django.db import transaction
+from django.db.models import F, Q
+
+from request.models import ActivationStatistic, Request, UpCloudPlan, UpCloudZone
+
+Kind = ActivationStatistic.Kind
+
+
+def _contribution(activated, deactivated, zone_name, plan_name) -> tuple[Counter, Counter]:
+    """The counts and seconds, keyed by (kind, name), that a single request adds to the statistics"""
+    counts = Counter()
+    seconds = Counter()
+    if zone_name:
+        counts[(Kind.ZONE, zone_name)] += 1
+    if plan_name:
+        counts[(Kind.PLAN, plan_name)] += 1
+    if activated and deactivated:
+        counts[(Kind.DURATION, "")] += 1
+        seconds[(Kind.DURATION, "")] += (deactivated - activated).total_seconds()
+    return counts, seconds
+
+
+def _names(zone_id, plan_id):
+    zone_name = UpCloudZone.objects.filter(pk=zone_id).values_list("name", flat=True).first() if zone_id else None
+    plan_name = UpCloudPlan.objects.filter(pk=plan_id).values_list("name", flat=True).first() if plan_id else None
+    return zone_name, plan_name
+
+
+def _apply(counts: Counter, seconds: Counter):
+    with transaction.atomic():
+        for key in sorted(set(counts) | set(seconds)):
+            if not counts[key] and not seconds[key]:
+                continue
+            kind, name = key
+            ActivationStatistic.objects.get_or_create(kind=kind, name=name)
+            ActivationStatistic.objects.filter(kind=kind, name=name).update(
+                count=F("count") + counts[key],
+                total_seconds=F("total_seconds") + seconds[key],
+            )
+
+
+def record_request_change(request: Request, deleted: bool = False):
+    """
+    Applies the difference between the request as it was loaded and as it was saved (or deleted) to
+    ActivationStatistic. Saves that do not touch the activation timestamps, zone or plan cost no queries.
+    """
+    old = request._statistics_snapshot
+    new = (None, None, None, None) if deleted else (request.activated, request.deactivated,
+                                                     request.upcloud_zone_id, request.upcloud_plan_id)
+    if old == new:
+        return
+
+    old_counts, old_seconds = _contribution(old[0], old[1], *_names(old[2], old[3]))
+    new_counts, new_seconds = _contribution(new[0], new[1], *_names(new[2], new[3]))
+    new_counts.subtract(old_counts)
+    new_seconds.subtract(old_seconds)
+    _apply(new_counts, new_seconds)
+    request.take_statistics_snapshot()
+
+
+def rebuild_activation_statistics() -> int:
+    """Recomputes ActivationStatistic from the request table, returns the number of rows written"""
+    counts = Counter()
+    seconds = Counter()
+    rows = (Request.objects.filter(Q(upcloud_zone__isnull=False) | Q(upcloud_plan__isnull=False) |
+                                   Q(activated__isnull=False, deactivated__isnull=False))
+            .values_list("activated", "deactivated", "upcloud_zone__name", "upcloud_plan__name")
+            .iterator(chunk_size=2000))
+    for row in rows:
+        row_counts, row_seconds = _contribution(*row)
+        counts.update(row_counts)
+        seconds.update(row_seconds)
+
+    with transaction.atomic():
+        ActivationStatistic.objects.all().delete()
+        ActivationStatistic.objects.bulk_create([
+            ActivationStatistic(kind=kind, name=name, count=counts[(kind, name)], total_seconds=seconds[(kind, name)])
+            for kind, name in counts
+        ])
+    return len(counts)
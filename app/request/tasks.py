@@ -1,5 +1,28 @@
+import functools
+import logging
+from datetime import timedelta
+
 import requests
 import dramatiq
+from cloudflare import APIStatusError, NotFoundError
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from dramatiq import pipeline
+
+from request.email import generate_request_activation_email, generate_request_received_admin_email, \
+    generate_request_received_email, send_mailjet_batch, MAILJET_BATCH_SIZE
+from request.helpers import cloudflare_dns_record_exists, create_upcloud_server, create_cloudflare_dns_entry, \
+    get_upcloud_server_state, stop_upcloud_server, delete_cloudflare_dns_entry, delete_cloudflare_dns_entries, \
+    delete_upcloud_server
+from request.caching import LANDING_PAGE, bump_version
+from request.catalog import sync_catalog
+from request.images import generate_image_derivatives, delete_image_derivatives
+from request.models import AppSettings, Request, ProvisioningState, Email, EmailStatus, PortfolioItem, CatalogSync, \
+    CloudflareZone
+
+logger = logging.getLogger(__name__)
 
 
 @dramatiq.actor(store_results=True)
@@ -39,3 +62,343 @@ def post_with_retry(url, payload=None, headers=None):
         return
 
     raise dramatiq.errors.Retry(f"Unexpected status code: {status}")
+
+
+class ProvisioningError(Exception):
+    """A provisioning step failed in a way that retrying will not fix"""
+
+
+class ServerNotStopped(Exception):
+    """The UpCloud server is still shutting down, raised to poll again with backoff"""
+
+
+PROVISIONING_STEP_OPTIONS = {
+    "max_retries": 3,
+    "min_backoff": 15_000,  # 15 seconds
+    "max_backoff": 120_000,
+    "throws": (ProvisioningError,),
+    "on_retry_exhausted": "mark_provisioning_failed",
+    "pipe_ignore": True,
+}
+
+
+def provisioning_step(state):
+    """
+    Loads the Request, records `state` on it and runs the step. A ProvisioningError fails the request
+    right away, anything else is recorded and left to the Retries middleware.
+    """
+
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(request_id):
+            request = Request.objects.select_related("cloudflare_zone", "upcloud_zone", "upcloud_plan") \
+                .get(pk=request_id)
+            request.set_provisioning_state(state)
+            try:
+                fn(request)
+            except ProvisioningError as exc:
+                request.set_provisioning_state(ProvisioningState.FAILED, str(exc))
+                raise
+            except Exception as exc:
+                request.set_provisioning_state(state, f"{type(exc).__name__}: {exc}")
+                raise
+
+        return wrapper
+
+    return decorator
+
+
+@dramatiq.actor(max_retries=0)
+def mark_provisioning_failed(message_data, retry_data):
+    request = Request.objects.get(pk=message_data["args"][0])
+    request.set_provisioning_state(ProvisioningState.FAILED, request.provisioning_error)
+
+
+# No longer part of ACTIVATION_STEPS, create_server checks the domain. Kept for pipelines queued before that.
+@dramatiq.actor(**PROVISIONING_STEP_OPTIONS)
+@provisioning_step(ProvisioningState.VALIDATING)
+def validate_domain(request):
+    if not request.upcloud_zone or not request.upcloud_plan:
+        raise ProvisioningError("Zone or Plan not set")
+    if request.upcloud_server_id:
+        # A retried pipeline, the domain was validated before the server got created
+        return
+    if cloudflare_dns_record_exists(request.cloudflare_zone, request.domain):
+        raise ProvisioningError(f"Domain {request.domain}.{request.cloudflare_zone.name} already exists")
+
+
+@dramatiq.actor(**PROVISIONING_STEP_OPTIONS)
+@provisioning_step(ProvisioningState.CREATING_SERVER)
+def create_server(request):
+    if request.upcloud_server_id:
+        return
+    if not request.upcloud_zone or not request.upcloud_plan:
+        raise ProvisioningError("Zone or Plan not set")
+    try:
+        # Checks that the domain is free while the init script and SSH keys are fetched
+        server_id, server_address = create_upcloud_server(request, check_dns=True)
+    except ValueError as exc:
+        raise ProvisioningError(str(exc))
+    if not server_id or not server_address:
+        raise ProvisioningError("Failed to create UpCloud server")
+
+
+@dramatiq.actor(**PROVISIONING_STEP_OPTIONS)
+@provisioning_step(ProvisioningState.CREATING_DNS)
+def create_dns(request):
+    if request.cloudflare_dns_record_id:
+        return
+    try:
+        request.cloudflare_dns_record_id = create_cloudflare_dns_entry(request.cloudflare_zone, request.domain,
+                                                                       request.upcloud_server_address)
+    except ValueError as exc:
+        raise ProvisioningError(str(exc))
+    request.save(update_fields=["cloudflare_dns_record_id", "modified"])
+
+
+@dramatiq.actor(**PROVISIONING_STEP_OPTIONS)
+@provisioning_step(ProvisioningState.SENDING_MAIL)
+def send_activation_mail(request):
+    generate_request_activation_email(request)
+    request.set_provisioning_state(ProvisioningState.ACTIVE)
+
+
+ACTIVATION_STEPS = [create_server, create_dns, send_activation_mail]
+
+
+def activate_request(request_id: int) -> None:
+    pipeline(step.message(request_id) for step in ACTIVATION_STEPS).run()
+
+
+def queue_activation(request: Request, user=None) -> None:
+    """
+    Approves the request and starts the activation pipeline once the transaction commits, in sandbox mode
+    the request is marked active right away. The caller saves the request.
+    """
+    request.is_approved = True
+    request.activated_by = user
+    request.provisioning_error = None
+    if AppSettings.load().sandbox_mode:
+        request.activated = timezone.now()
+        request.provisioning_state = ProvisioningState.ACTIVE
+    else:
+        request.provisioning_state = ProvisioningState.QUEUED
+        transaction.on_commit(functools.partial(activate_request, request.pk))
+
+
+def queue_deactivation(request: Request, user=None) -> None:
+    """Starts deprovision_request once the transaction commits, see queue_activation"""
+    request.deactivated_by = user
+    request.provisioning_error = None
+    if AppSettings.load().sandbox_mode:
+        request.deactivated = timezone.now()
+        request.provisioning_state = ProvisioningState.DEACTIVATED
+    else:
+        request.provisioning_state = ProvisioningState.DEPROVISIONING
+        transaction.on_commit(functools.partial(deprovision_request.send, request.pk))
+
+
+@dramatiq.actor(
+    max_retries=20,
+    min_backoff=5_000,  # 5 seconds, doubling on every poll
+    max_backoff=300_000,
+    throws=(ProvisioningError,),
+    on_retry_exhausted="mark_provisioning_failed",
+)
+def deprovision_request(request_id):
+    """
+    Tears down a Request as a state machine: stop the server and wait until UpCloud reports it stopped,
+    then delete the DNS record, then delete the server with its storages. Every retry resumes from the state
+    stored on the Request, so a deleted server is never attempted twice and storage is only deleted once
+    the server is stopped.
+    """
+    request = Request.objects.select_related("cloudflare_zone").get(pk=request_id)
+    state = request.provisioning_state
+    try:
+        if state in (ProvisioningState.DEPROVISIONING, ProvisioningState.STOPPING_SERVER):
+            request.set_provisioning_state(ProvisioningState.STOPPING_SERVER)
+            if request.upcloud_server_id:
+                server_state = get_upcloud_server_state(request)
+                if server_state == "started":
+                    stop_upcloud_server(request)
+                if server_state not in (None, "stopped"):
+                    raise ServerNotStopped(f"Server {request.upcloud_server_id} is {server_state}")
+            state = ProvisioningState.DELETING_DNS
+            request.set_provisioning_state(state)
+
+        if state == ProvisioningState.DELETING_DNS:
+            try:
+                delete_cloudflare_dns_entry(request.cloudflare_zone, request.cloudflare_dns_record_id, request.domain)
+            except NotFoundError:
+                pass
+            state = ProvisioningState.DELETING_SERVER
+            request.set_provisioning_state(state)
+
+        if state == ProvisioningState.DELETING_SERVER:
+            if request.upcloud_server_id:
+                status = delete_upcloud_server(request)
+                if status == 409:
+                    # SERVER_STATE_ILLEGAL, the server got started again in the meantime
+                    request.set_provisioning_state(ProvisioningState.STOPPING_SERVER)
+                    raise ServerNotStopped(f"Server {request.upcloud_server_id} is not stopped")
+                if status is not None and status not in (200, 202, 204, 404):
+                    raise RuntimeError(f"Unexpected status code from UpCloud: {status}")
+            request.deactivated = request.deactivated or timezone.now()
+            request.save(update_fields=["deactivated", "modified"])
+            request.set_provisioning_state(ProvisioningState.DEACTIVATED)
+            return
+
+        raise ProvisioningError(f"Cannot deprovision a request in state '{state}'")
+    except ServerNotStopped:
+        raise
+    except ProvisioningError as exc:
+        request.set_provisioning_state(ProvisioningState.FAILED, str(exc))
+        raise
+    except Exception as exc:
+        request.set_provisioning_state(request.provisioning_state, f"{type(exc).__name__}: {exc}")
+        raise
+
+
+# Emails a worker claimed but never recorded a result for are sent again after this long
+EMAIL_SENDING_TIMEOUT = timedelta(minutes=10)
+
+
+@dramatiq.actor(max_retries=5, min_backoff=5_000)
+def delete_dns_records(zone_id, request_ids):
+    """
+    Deletes the DNS records of requests deactivated together with one batch call per zone, queued by the admin
+    deactivate action next to their deprovision_request messages. The ids are cleared once the records are gone,
+    so deprovision_request skips them.
+    """
+    if AppSettings.load().sandbox_mode:
+        return
+    zone = CloudflareZone.objects.get(pk=zone_id)
+    rows = Request.objects.filter(pk__in=request_ids, cloudflare_zone=zone, cloudflare_dns_record_id__isnull=False)
+    records = dict(rows.values_list("cloudflare_dns_record_id", "domain"))
+    try:
+        delete_cloudflare_dns_entries(zone, records)
+    except APIStatusError:
+        # The batch fails as a whole when a deprovision_request got to one of the records first
+        for record_id, domain in records.items():
+            try:
+                delete_cloudflare_dns_entry(zone, record_id, domain)
+            except NotFoundError:
+                pass
+    rows.filter(cloudflare_dns_record_id__in=records).update(cloudflare_dns_record_id=None)
+
+
+@dramatiq.actor(max_retries=5, min_backoff=30_000, max_backoff=600_000)
+def send_queued_emails():
+    """Drains the Email outbox, sending up to MAILJET_BATCH_SIZE messages per Mailjet call"""
+    Email.objects.filter(status=EmailStatus.SENDING, modified__lt=timezone.now() - EMAIL_SENDING_TIMEOUT) \
+        .update(status=EmailStatus.QUEUED)
+
+    while True:
+        with transaction.atomic():
+            emails = list(Email.objects.select_for_update(skip_locked=True)
+                          .filter(status=EmailStatus.QUEUED).order_by("pk")[:MAILJET_BATCH_SIZE])
+            Email.objects.filter(pk__in=[email.pk for email in emails]) \
+                .update(status=EmailStatus.SENDING, modified=timezone.now())
+        if not emails:
+            return
+        try:
+            send_mailjet_batch(emails)
+        except Exception:
+            Email.objects.filter(pk__in=[email.pk for email in emails], status=EmailStatus.SENDING) \
+                .update(status=EmailStatus.QUEUED)
+            raise
+
+
+@dramatiq.actor(max_retries=3)
+def send_request_received_emails(request_id):
+    request = Request.objects.select_related("cloudflare_zone").get(pk=request_id)
+    generate_request_received_admin_email(request)
+    generate_request_received_email(request)
+
+
+@dramatiq.actor(max_retries=3, time_limit=5 * 60_000)
+def generate_portfolio_image_derivatives(item_id):
+    item = PortfolioItem.objects.get(pk=item_id)
+    if not item.image_derivatives_stale:
+        return
+    previous = item.image_derivatives
+    derivatives = generate_image_derivatives(item.image)
+    # update() does not send post_save, which would queue this actor again
+    if PortfolioItem.objects.filter(pk=item.pk, image=derivatives["source"]).update(image_derivatives=derivatives):
+        # The files of the previous image are no longer referenced once the new set is saved
+        delete_image_derivatives(item.image.storage, previous, keep=derivatives)
+    bump_version(LANDING_PAGE)
+
+
+@dramatiq.actor(max_retries=3, min_backoff=60_000, time_limit=5 * 60_000)
+def sync_catalogs():
+    """Refreshes the zones and plans offered on the request form, a failing catalog does not stop the others"""
+    failed = []
+    for name in CatalogSync.Catalog:
+        try:
+            sync_catalog(name)
+        except Exception:
+            logger.exception("Syncing %s failed", name)
+            failed.append(name)
+    if failed:
+        raise RuntimeError(f"Catalog sync failed for {', '.join(failed)}")
+
+
+def due_for_activation(today):
+    """Approved requests whose inception date has arrived, served by the request_pending_inception index"""
+    return (Request.objects
+            .filter(is_approved=True, activated__isnull=True, inception_date__lte=today,
+                    provisioning_state=ProvisioningState.NOT_STARTED,
+                    upcloud_zone__isnull=False, upcloud_plan__isnull=False)
+            .order_by("inception_date", "pk"))
+
+
+def due_for_teardown(now):
+    """
+    Active requests whose party ended more than AUTO_TEARDOWN_GRACE_HOURS ago. Failed requests are included
+    when they still have a server, an activation that failed after the server was created keeps it running.
+    """
+    party_over = timezone.localdate(now - timedelta(hours=settings.AUTO_TEARDOWN_GRACE_HOURS))
+    has_server = Q(upcloud_server_id__isnull=False) & ~Q(upcloud_server_id="")
+    return (Request.objects
+            .filter(activated__isnull=False, deactivated__isnull=True, party_end__lt=party_over)
+            .filter(~Q(provisioning_state=ProvisioningState.FAILED) | has_server)
+            .exclude(provisioning_state__in=ProvisioningState.in_progress())
+            .order_by("party_end", "pk"))
+
+
+def plan_auto_provisioning() -> dict[str, list[Request]]:
+    """
+    Picks the requests to tear down and activate in this run. Teardowns go first as they stop billing, and
+    together with the requests already provisioning no more than AUTO_PROVISIONING_MAX_IN_FLIGHT run at once.
+    Whatever does not fit is picked up by a later run.
+    """
+    now = timezone.now()
+    in_flight = Request.objects.filter(provisioning_state__in=ProvisioningState.in_progress()).count()
+    slots = max(0, settings.AUTO_PROVISIONING_MAX_IN_FLIGHT - in_flight)
+    teardown = list(due_for_teardown(now)[:slots])
+    activate = list(due_for_activation(timezone.localdate(now))[:slots - len(teardown)])
+    return {"teardown": teardown, "activate": activate}
+
+
+def run_auto_provisioning(dry_run: bool = False) -> dict[str, list[Request]]:
+    """Queues the teardowns and activations picked by plan_auto_provisioning, or only reports them"""
+    plan = plan_auto_provisioning()
+    if not dry_run:
+        with transaction.atomic():
+            for request in plan["teardown"]:
+                queue_deactivation(request)
+                request.save()
+            for request in plan["activate"]:
+                queue_activation(request)
+                request.save()
+    for action, requests in plan.items():
+        for request in requests:
+            logger.info("%s %s (%s)%s", action, request, request.domain, " [dry run]" if dry_run else "")
+    return plan
+
+
+@dramatiq.actor(max_retries=0)
+def auto_provision():
+    if settings.AUTO_PROVISIONING:
+        run_auto_provisioning()
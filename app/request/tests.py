@@ -1,25 +1,57 @@
 from datetime import date, timedelta
+from io import BytesIO, StringIO
+import json
+import tempfile
+import threading
+from types import SimpleNamespace
+from unittest import mock
 
-from django.test import RequestFactory, TestCase
+from PIL import Image
+from cryptography.fernet import Fernet, MultiFernet
+from django.contrib.admin.sites import AdminSite
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
+from django.core.management import call_command
+from django.template.loader import render_to_string
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import RequestFactory, TestCase, override_settings
 from django.utils import timezone
-from django.db.models.signals import pre_save
+from django.utils.html import strip_tags
+from django.db.models.signals import post_save
 
-from request.models import CloudflareZone, Request, Email
-from request.views import ActivationListView
+import requests
+from prometheus_client import REGISTRY, generate_latest
+
+from request.helpers import CloudflareDNSIndex, prepare_upcloud_server, fetch_init_script, INIT_SCRIPT_CACHE_KEY
+from request.clients import get_upcloud_client, get_cloudflare_client
+from request import models
+from request.admin import RequestAdmin
+from request.catalog import sync_catalog
+from request.limits import ProviderBusy, provider_slot
+from request.metrics import build_registry, external_call
+from request.reconcile import GHOST_SERVER, ORPHAN_SERVER, UNKNOWN_SERVER, reconcile
+from request.scheduler import PERIODIC_JOBS, PeriodicJob, Scheduler
+from request.email import _text_template, queue_request_emails, send_mailjet_batch
+from request.models import AppSettings, CloudflareZone, PortfolioItem, ExternalURL, Testimonial, Request, Email, \
+    EmailStatus, ActivationStatistic, CatalogSync, UpCloudZone, UpCloudPlan, ProvisioningState, SSHKeys
+from request.tasks import ProvisioningError, ServerNotStopped, validate_domain, create_server, deprovision_request, \
+    send_queued_emails, send_request_received_emails, generate_portfolio_image_derivatives, run_auto_provisioning, \
+    due_for_teardown, delete_dns_records, EMAIL_SENDING_TIMEOUT
+from request.views import ActivationListView, LandingPageView
 from request.signals import prepare_request_received_emails, send_email
 
 
-class ActivationListViewTests(TestCase):
+class RequestTestCase(TestCase):
     @classmethod
     def setUpClass(cls):
         super().setUpClass()
-        pre_save.disconnect(prepare_request_received_emails, sender=Request)
-        pre_save.disconnect(send_email, sender=Email)
+        post_save.disconnect(prepare_request_received_emails, sender=Request)
+        post_save.disconnect(send_email, sender=Email)
 
     @classmethod
     def tearDownClass(cls):
-        pre_save.connect(prepare_request_received_emails, sender=Request)
-        pre_save.connect(send_email, sender=Email)
+        post_save.connect(prepare_request_received_emails, sender=Request)
+        post_save.connect(send_email, sender=Email)
         super().tearDownClass()
 
     def setUp(self):
@@ -44,6 +76,8 @@ class ActivationListViewTests(TestCase):
             deactivated=deactivated
         )
 
+
+class ActivationListViewTests(RequestTestCase):
     def _get_queryset_ids(self):
         request = self.factory.get("/activation/")
         view = ActivationListView()
@@ -87,6 +121,30 @@ class ActivationListViewTests(TestCase):
             ],
         )
 
+    def test_rows_past_the_first_page_are_loaded_by_keyset_cursor(self):
+        for i in range(5):
+            self.create_request(domain=f"party{i}", party_start=date(2020 + i, 1, 1))
+
+        with mock.patch.object(ActivationListView, "paginate_by", 2):
+            response = ActivationListView.as_view()(self.factory.get("/activation/"))
+            seen = [row.domain for row in response.context_data["object_list"]]
+            next_url = response.context_data["next_url"]
+            while next_url:
+                response = ActivationListView.as_view()(self.factory.get(next_url))
+                self.assertEqual(response.template_name, ["request/activation-list-rows.html"])
+                seen += [row.domain for row in response.context_data["object_list"]]
+                next_url = response.context_data["next_url"]
+
+        self.assertEqual(seen, ["party4", "party3", "party2", "party1", "party0"])
+
+    def test_activation_list_filters_by_year(self):
+        self.create_request(domain="old", party_start=date(2020, 1, 1))
+        self.create_request(domain="new", party_start=date(2025, 1, 1))
+
+        response = ActivationListView.as_view()(self.factory.get("/activation/", {"year": "2025"}))
+
+        self.assertEqual([row.domain for row in response.context_data["object_list"]], ["new"])
+
     def test_activation_list_view_returns_http_200(self):
         self.create_request(
             domain="smoke",
@@ -97,3 +155,870 @@ class ActivationListViewTests(TestCase):
         response = ActivationListView.as_view()(request)
 
         self.assertEqual(response.status_code, 200)
+
+
+class ActivationStatisticTests(RequestTestCase):
+    def setUp(self):
+        super().setUp()
+        self.zone = UpCloudZone.objects.create(name="fi-hel1")
+        self.plan = UpCloudPlan.objects.create(name="1xCPU-1GB", description="Small")
+
+    def stats(self):
+        return {(stat.kind, stat.name): (stat.count, stat.total_seconds) for stat in ActivationStatistic.objects.all()}
+
+    def test_statistics_follow_activation_and_deactivation(self):
+        request = self.create_request(domain="party", party_start=date(2025, 6, 1))
+        request.upcloud_zone = self.zone
+        request.upcloud_plan = self.plan
+        request.save()
+        # like the aggregation it replaces, every request with a zone or plan is counted, activated or not
+        self.assertEqual(self.stats(), {("zone", "fi-hel1"): (1, 0), ("plan", "1xCPU-1GB"): (1, 0)})
+
+        request = Request.objects.get(pk=request.pk)
+        request.activated = timezone.now() - timedelta(hours=2)
+        request.save()
+        self.assertEqual(self.stats(), {("zone", "fi-hel1"): (1, 0), ("plan", "1xCPU-1GB"): (1, 0)})
+
+        request.deactivated = request.activated + timedelta(hours=2)
+        request.save()
+        self.assertEqual(self.stats()[("duration", "")], (1, 7200))
+
+        # saves that do not change the activation are free
+        with self.assertNumQueries(1):
+            request.set_provisioning_state(ProvisioningState.DEACTIVATED)
+
+        request.delete()
+        self.assertEqual({key: value for key, value in self.stats().items() if value[0]}, {})
+
+    def test_rebuild_matches_incremental_statistics(self):
+        for i in range(3):
+            request = self.create_request(domain=f"party{i}", party_start=date(2025, 6, 1),
+                                          activated=timezone.now() - timedelta(days=i + 1),
+                                          deactivated=timezone.now() if i else None)
+            request.upcloud_zone = self.zone
+            request.save()
+        request = self.create_request(domain="requested", party_start=date(2025, 6, 1))
+        request.upcloud_zone = self.zone
+        request.save()
+        incremental = self.stats()
+
+        call_command("rebuild_activation_statistics", stdout=StringIO())
+
+        self.assertEqual(self.stats(), incremental)
+        view = ActivationListView()
+        view.setup(self.factory.get("/activation/"))
+        view.object_list = view.get_queryset()
+        ctx = view.get_context_data()
+        self.assertEqual([(zone.name, zone.count) for zone in ctx["zones"]], [("fi-hel1", 4)])
+        self.assertEqual(ctx["average_duration_activated"].days, 2)
+
+
+class ActivationPipelineTests(RequestTestCase):
+    def setUp(self):
+        super().setUp()
+        self.request = self.create_request(domain="myparty", party_start=date(2025, 6, 1))
+        self.request.upcloud_zone = UpCloudZone.objects.create(name="fi-hel1")
+        self.request.upcloud_plan = UpCloudPlan.objects.create(name="1xCPU-2GB", description="Small")
+        self.request.save()
+
+    def test_validate_domain_fails_request_when_dns_record_exists(self):
+        with mock.patch("request.tasks.cloudflare_dns_record_exists", return_value=True):
+            with self.assertRaises(ProvisioningError):
+                validate_domain(self.request.pk)
+
+        self.request.refresh_from_db()
+        self.assertEqual(self.request.provisioning_state, ProvisioningState.FAILED)
+        self.assertIn("myparty.example.com", self.request.provisioning_error)
+
+    def test_create_server_records_transient_errors_and_keeps_state(self):
+        with mock.patch("request.tasks.create_upcloud_server", side_effect=KeyError("server")):
+            with self.assertRaises(KeyError):
+                create_server(self.request.pk)
+
+        self.request.refresh_from_db()
+        self.assertEqual(self.request.provisioning_state, ProvisioningState.CREATING_SERVER)
+        self.assertTrue(self.request.provisioning_error)
+
+    def test_server_payload_lookups_run_concurrently(self):
+        SSHKeys.objects.create(user="admin", public_key="ssh-ed25519 AAAA admin")
+
+        # Both lookups wait for each other, run one after the other the barrier breaks after its timeout
+        barrier = threading.Barrier(2, timeout=5)
+
+        def together(result):
+            def wait(*args, **kwargs):
+                barrier.wait()
+                return result
+            return wait
+
+        with mock.patch("request.helpers.CloudflareDNSIndex.exists", side_effect=together(False)), \
+                mock.patch("request.helpers.fetch_init_script", side_effect=together("#!/bin/sh\necho $IP\n")):
+            payload = prepare_upcloud_server(self.request)
+
+        self.assertIn("echo myparty.example.com", payload["server"]["user_data"])
+        self.assertEqual(payload["server"]["login_user"]["ssh_keys"]["ssh_key"], ["ssh-ed25519 AAAA admin"])
+
+    def test_create_server_fails_request_when_dns_record_exists(self):
+        SSHKeys.objects.create(user="admin", public_key="ssh-ed25519 AAAA admin")
+        with mock.patch("request.helpers.AppSettings.load", return_value=SimpleNamespace(sandbox_mode=False)), \
+                mock.patch("request.helpers.CloudflareDNSIndex.exists", return_value=True), \
+                mock.patch("request.helpers.fetch_init_script", return_value=""), \
+                mock.patch("request.helpers.get_upcloud_client") as client:
+            with self.assertRaises(ProvisioningError):
+                create_server(self.request.pk)
+
+        client.assert_not_called()
+        self.request.refresh_from_db()
+        self.assertEqual(self.request.provisioning_state, ProvisioningState.FAILED)
+        self.assertIn("myparty.example.com", self.request.provisioning_error)
+
+    def test_create_server_is_skipped_when_server_already_exists(self):
+        Request.objects.filter(pk=self.request.pk).update(upcloud_server_id="server-1")
+        with mock.patch("request.tasks.create_upcloud_server") as create:
+            create_server(self.request.pk)
+
+        create.assert_not_called()
+
+
+class DeprovisioningTests(RequestTestCase):
+    def setUp(self):
+        super().setUp()
+        self.request = self.create_request(domain="myparty", party_start=date(2025, 6, 1),
+                                           activated=timezone.now() - timedelta(days=3))
+        self.request.upcloud_server_id = "server-1"
+        self.request.cloudflare_dns_record_id = "record-1"
+        self.request.provisioning_state = ProvisioningState.DEPROVISIONING
+        self.request.save()
+
+    def test_waits_for_server_to_stop_before_deleting(self):
+        with mock.patch("request.tasks.get_upcloud_server_state", return_value="started"), \
+                mock.patch("request.tasks.stop_upcloud_server") as stop, \
+                mock.patch("request.tasks.delete_upcloud_server") as delete:
+            with self.assertRaises(ServerNotStopped):
+                deprovision_request(self.request.pk)
+
+        stop.assert_called_once()
+        delete.assert_not_called()
+        self.request.refresh_from_db()
+        self.assertEqual(self.request.provisioning_state, ProvisioningState.STOPPING_SERVER)
+        self.assertIsNone(self.request.deactivated)
+
+    def test_deletes_dns_and_server_once_stopped(self):
+        with mock.patch("request.tasks.get_upcloud_server_state", return_value="stopped"), \
+                mock.patch("request.tasks.delete_cloudflare_dns_entry") as delete_dns, \
+                mock.patch("request.tasks.delete_upcloud_server", return_value=204) as delete:
+            deprovision_request(self.request.pk)
+
+        delete_dns.assert_called_once_with(self.cloudflare_zone, "record-1", "myparty")
+        delete.assert_called_once()
+        self.request.refresh_from_db()
+        self.assertEqual(self.request.provisioning_state, ProvisioningState.DEACTIVATED)
+        self.assertIsNotNone(self.request.deactivated)
+        self.assertEqual([entry["state"] for entry in self.request.provisioning_log],
+                         ["stopping_server", "deleting_dns", "deleting_server", "deactivated"])
+
+    @override_settings(PROVIDER_LIMITER_URL="")
+    def test_server_started_again_is_not_marked_deactivated(self):
+        Request.objects.filter(pk=self.request.pk).update(provisioning_state=ProvisioningState.DELETING_SERVER)
+        upcloud = mock.Mock()
+        upcloud.delete.return_value = mock.Mock(status_code=409)
+        with mock.patch("request.helpers.AppSettings.load", return_value=SimpleNamespace(sandbox_mode=False)), \
+                mock.patch("request.helpers.get_upcloud_client", return_value=upcloud), \
+                mock.patch("request.limits._backend", None):
+            with self.assertRaises(ServerNotStopped):
+                deprovision_request(self.request.pk)
+
+        self.request.refresh_from_db()
+        self.assertEqual(self.request.provisioning_state, ProvisioningState.STOPPING_SERVER)
+        self.assertIsNone(self.request.deactivated)
+
+
+class ReconcileTests(RequestTestCase):
+    def setUp(self):
+        super().setUp()
+        now = timezone.now()
+        self.active = self.create_request(domain="active", party_start=date(2025, 6, 1), activated=now)
+        self.lost = self.create_request(domain="lost", party_start=date(2025, 6, 1), activated=now)
+        self.leaked = self.create_request(domain="leaked", party_start=date(2025, 1, 1),
+                                          activated=now - timedelta(days=9), deactivated=now - timedelta(days=7))
+        for request, server_id, record_id in [(self.active, "server-active", "record-active"),
+                                              (self.lost, "server-lost", "record-lost"),
+                                              (self.leaked, "server-leaked", "record-leaked")]:
+            request.upcloud_server_id = server_id
+            request.cloudflare_dns_record_id = record_id
+            request.save()
+
+        servers = {"servers": {"server": [
+            {"uuid": "server-active", "hostname": "active.example.com", "state": "started"},
+            {"uuid": "server-leaked", "hostname": "leaked.example.com", "state": "started"},
+            {"uuid": "server-stray", "hostname": "stray.example.com", "state": "started"},
+            {"uuid": "server-other", "hostname": "mail.elsewhere.org", "state": "started"},
+        ]}}
+        self.upcloud = mock.Mock()
+        self.upcloud.get.return_value = mock.Mock(status_code=200, json=mock.Mock(return_value=servers))
+        self.cloudflare = mock.Mock()
+        self.cloudflare.dns.records.list.return_value = iter([
+            SimpleNamespace(id="record-active", name="active.example.com", content="192.0.2.1"),
+            SimpleNamespace(id="record-lost", name="lost.example.com", content="192.0.2.2"),
+        ])
+        for target, value in [("request.reconcile.get_upcloud_client", self.upcloud),
+                              ("request.reconcile.get_cloudflare_client", self.cloudflare),
+                              ("request.reconcile.AppSettings.load", SimpleNamespace(sandbox_mode=False))]:
+            patcher = mock.patch(target, return_value=value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_reports_orphans_and_ghosts_with_one_list_call_per_provider(self):
+        drift = {(finding.kind, finding.provider_id) for finding in reconcile()}
+
+        self.assertEqual(drift, {
+            (GHOST_SERVER, "server-lost"),
+            (ORPHAN_SERVER, "server-leaked"),
+            (UNKNOWN_SERVER, "server-stray"),
+        })
+        self.upcloud.get.assert_called_once_with("/1.3/server")
+        self.cloudflare.dns.records.list.assert_called_once()
+
+    def test_fix_deprovisions_leaked_servers_and_only_reports_lost_ones(self):
+        state = self.lost.provisioning_state
+        with self.captureOnCommitCallbacks(execute=False) as callbacks:
+            reconcile(fix=True)
+
+        self.assertEqual(len(callbacks), 1)
+        self.leaked.refresh_from_db()
+        self.lost.refresh_from_db()
+        self.assertEqual(self.leaked.provisioning_state, ProvisioningState.DEPROVISIONING)
+        # the party of an active request may still be going on
+        self.assertEqual(self.lost.provisioning_state, state)
+        self.assertIsNone(self.lost.deactivated)
+
+    def test_a_failing_fix_does_not_stop_the_others(self):
+        with mock.patch("request.reconcile.fix_drift", side_effect=RuntimeError("provider down")) as fix, \
+                self.assertLogs("request.reconcile", "ERROR"):
+            drift = reconcile(fix=True)
+
+        self.assertEqual(fix.call_count, len(drift))
+
+
+@override_settings(AUTO_TEARDOWN_GRACE_HOURS=24, AUTO_PROVISIONING_MAX_IN_FLIGHT=2)
+class AutoProvisioningTests(RequestTestCase):
+    def setUp(self):
+        super().setUp()
+        self.zone = UpCloudZone.objects.create(name="fi-hel1")
+        self.plan = UpCloudPlan.objects.create(name="1xCPU-1GB", description="Small")
+        today = timezone.localdate()
+        self.over = self.create_request(domain="over", party_start=today - timedelta(days=5),
+                                        activated=timezone.now() - timedelta(days=6))
+        self.running = self.create_request(domain="running", party_start=today - timedelta(days=1),
+                                           activated=timezone.now() - timedelta(days=2))
+        self.due = [self.approved(f"due{i}", today + timedelta(days=2)) for i in range(2)]
+        self.not_yet = self.approved("not-yet", today + timedelta(days=30))
+        patcher = mock.patch("request.tasks.AppSettings.load", return_value=SimpleNamespace(sandbox_mode=False))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def approved(self, domain, party_start):
+        request = self.create_request(domain=domain, party_start=party_start)
+        request.is_approved = True
+        request.upcloud_zone = self.zone
+        request.upcloud_plan = self.plan
+        request.save()
+        return request
+
+    def test_dry_run_reports_teardowns_first_within_the_concurrency_limit(self):
+        plan = run_auto_provisioning(dry_run=True)
+
+        self.assertEqual(plan, {"teardown": [self.over], "activate": [self.due[0]]})
+        self.over.refresh_from_db()
+        self.assertEqual(self.over.provisioning_state, ProvisioningState.NOT_STARTED)
+
+    def test_failed_requests_are_torn_down_only_when_they_kept_a_server(self):
+        today = timezone.localdate()
+        for domain, server_id in (("failed-server", "server-1"), ("failed-nothing", None)):
+            request = self.create_request(domain=domain, party_start=today - timedelta(days=6),
+                                          activated=timezone.now() - timedelta(days=7))
+            request.upcloud_server_id = server_id
+            request.provisioning_state = ProvisioningState.FAILED
+            request.save()
+
+        self.assertEqual([request.domain for request in due_for_teardown(timezone.now())],
+                         ["failed-server", "over"])
+
+    def test_run_queues_jobs_and_counts_requests_already_in_flight(self):
+        with self.captureOnCommitCallbacks(execute=False) as callbacks:
+            run_auto_provisioning()
+        self.assertEqual(len(callbacks), 2)
+        self.over.refresh_from_db()
+        self.due[0].refresh_from_db()
+        self.assertEqual(self.over.provisioning_state, ProvisioningState.DEPROVISIONING)
+        self.assertEqual(self.due[0].provisioning_state, ProvisioningState.QUEUED)
+
+        self.assertEqual(run_auto_provisioning(dry_run=True), {"teardown": [], "activate": []})
+
+
+class ActivationStatusViewTests(RequestTestCase):
+    async def test_status_is_read_from_the_database_without_calling_the_providers(self):
+        request = await Request.objects.acreate(
+            party_name="Party", contact_email="party@example.com", party_start=date(2025, 6, 1),
+            party_end=date(2025, 6, 3), inception_date=date(2025, 5, 20), domain="party",
+            cloudflare_zone=self.cloudflare_zone, upcloud_server_id="server-1",
+            provisioning_state=ProvisioningState.CREATING_DNS)
+
+        with mock.patch("request.helpers.get_upcloud_client") as upcloud, \
+                mock.patch("request.helpers.get_cloudflare_client") as cloudflare:
+            response = await self.async_client.get(f"/activation/{request.pk}/status/")
+
+        data = response.json()
+        self.assertEqual(data["state"], ProvisioningState.CREATING_DNS)
+        self.assertTrue(data["in_progress"])
+        upcloud.assert_not_called()
+        cloudflare.assert_not_called()
+
+    def test_status_of_an_unknown_request_is_not_found(self):
+        self.assertEqual(self.client.get("/activation/999999/status/").status_code, 404)
+
+
+class ProviderClientTests(TestCase):
+    def _settings(self, password):
+        return SimpleNamespace(upcloud_api_url="https://api.upcloud.com", upcloud_api_username="user",
+                               upcloud_api_password=password)
+
+    def test_upcloud_client_is_reused_until_credentials_change(self):
+        with mock.patch("request.clients.AppSettings.load", return_value=self._settings("first")):
+            client = get_upcloud_client()
+            self.assertIs(get_upcloud_client(), client)
+
+        with mock.patch("request.clients.AppSettings.load", return_value=self._settings("second")):
+            self.assertIsNot(get_upcloud_client(), client)
+
+    def test_cloudflare_client_is_rebuilt_when_token_changes(self):
+        with mock.patch("request.clients.AppSettings.load", return_value=SimpleNamespace(cloudflare_api_token="a")):
+            client = get_cloudflare_client()
+            self.assertIs(get_cloudflare_client(), client)
+
+        with mock.patch("request.clients.AppSettings.load", return_value=SimpleNamespace(cloudflare_api_token="b")):
+            self.assertIsNot(get_cloudflare_client(), client)
+
+
+class CloudflareDNSIndexTests(TestCase):
+    def setUp(self):
+        cache.delete_many(["cloudflare-dns:zone-index:myparty.example.com"])
+        self.zone = CloudflareZone(name="example.com", cloudflare_id="zone-index")
+        self.client = mock.Mock()
+        self.client.dns.records.list.return_value = SimpleNamespace(result=[])
+        patcher = mock.patch("request.helpers.get_cloudflare_client", return_value=self.client)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_lookup_filters_by_name_and_caches_misses(self):
+        index = CloudflareDNSIndex(self.zone)
+
+        self.assertFalse(index.exists("myparty.example.com"))
+        self.assertFalse(index.exists("myparty.example.com"))
+
+        self.client.dns.records.list.assert_called_once_with(zone_id="zone-index",
+                                                              name={"exact": "myparty.example.com"}, per_page=1)
+
+    def test_add_and_remove_update_the_cache(self):
+        index = CloudflareDNSIndex(self.zone)
+
+        index.add("myparty.example.com", "record-1")
+        self.assertEqual(index.lookup("myparty.example.com"), "record-1")
+        index.remove("myparty.example.com")
+        self.assertFalse(index.exists("myparty.example.com"))
+        self.client.dns.records.list.assert_not_called()
+
+
+class CatalogSyncTests(TestCase):
+    def setUp(self):
+        patcher = mock.patch("request.catalog.AppSettings.load", return_value=SimpleNamespace(sandbox_mode=False))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_cloudflare_zones_are_created_renamed_hidden_and_unhidden(self):
+        renamed = CloudflareZone.objects.create(name="old.example", cloudflare_id="zone-renamed")
+        gone = CloudflareZone.objects.create(name="gone.example", cloudflare_id="zone-gone")
+        back = CloudflareZone.objects.create(name="back.example", cloudflare_id="zone-back", visible=False,
+                                             missing_since=timezone.now())
+        hidden_by_hand = CloudflareZone.objects.create(name="manual.example", cloudflare_id="zone-manual",
+                                                       visible=False)
+        zones = [SimpleNamespace(id=zone_id, name=name) for zone_id, name in [
+            ("zone-renamed", "new.example"), ("zone-back", "back.example"), ("zone-manual", "manual.example"),
+            ("zone-new", "new-zone.example")]]
+        client = mock.Mock()
+        client.zones.list.return_value = iter(zones)
+
+        with mock.patch("request.catalog.get_cloudflare_client", return_value=client):
+            sync = sync_catalog(CatalogSync.Catalog.CLOUDFLARE_ZONES)
+
+        self.assertEqual((sync.created, sync.renamed, sync.hidden, sync.unhidden), (1, 1, 1, 1))
+        renamed.refresh_from_db()
+        gone.refresh_from_db()
+        back.refresh_from_db()
+        hidden_by_hand.refresh_from_db()
+        self.assertEqual(renamed.name, "new.example")
+        self.assertFalse(gone.visible)
+        self.assertIsNotNone(gone.missing_since)
+        self.assertTrue(back.visible)
+        self.assertFalse(hidden_by_hand.visible)
+        self.assertTrue(CloudflareZone.objects.filter(cloudflare_id="zone-new", public=False).exists())
+
+    def test_new_upcloud_plans_are_hidden_and_get_a_description_only_when_created(self):
+        UpCloudPlan.objects.create(name="1xCPU-1GB", description="Edited by hand")
+        plans = {"plans": {"plan": [
+            {"name": "1xCPU-1GB", "core_number": 1, "memory_amount": 1024, "storage_size": 25},
+            {"name": "2xCPU-4GB", "core_number": 2, "memory_amount": 4096, "storage_size": 80},
+        ]}}
+        client = mock.Mock()
+        client.get.return_value = mock.Mock(status_code=200, json=mock.Mock(return_value=plans))
+
+        with mock.patch("request.catalog.get_upcloud_client", return_value=client):
+            sync_catalog(CatalogSync.Catalog.UPCLOUD_PLANS)
+
+        self.assertEqual(dict(UpCloudPlan.objects.values_list("name", "description")), {
+            "1xCPU-1GB": "Edited by hand",
+            "2xCPU-4GB": "2 CPU, 4 GB RAM, 80 GB storage",
+        })
+        # new plans are only offered on the form once they are made visible in the admin
+        self.assertEqual(dict(UpCloudPlan.objects.values_list("name", "visible")), {
+            "1xCPU-1GB": True,
+            "2xCPU-4GB": False,
+        })
+
+
+class SchedulerTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.actor = mock.Mock()
+        self.jobs = [PeriodicJob("job", self.actor, timedelta(minutes=15), {"x": 1})]
+
+    def test_due_jobs_are_enqueued_once_per_interval(self):
+        scheduler = Scheduler(self.jobs)
+
+        self.assertEqual(scheduler.tick(now=1000), self.jobs)
+        self.assertEqual(scheduler.tick(now=1000 + 60), [])
+        self.assertEqual(scheduler.tick(now=1000 + 15 * 60), self.jobs)
+        self.assertEqual(self.actor.send.call_args_list, [mock.call(x=1)] * 2)
+
+    def test_only_the_leader_enqueues(self):
+        leader = Scheduler(self.jobs)
+        follower = Scheduler(self.jobs)
+        leader.tick(now=1000)
+
+        self.assertEqual(follower.tick(now=5000), [])
+        leader.release()
+        # the schedule survives the change of leader
+        self.assertEqual(follower.tick(now=1000 + 60), [])
+        self.assertEqual(follower.tick(now=5000), self.jobs)
+
+    def test_email_outbox_is_drained_periodically(self):
+        # emails whose send_queued_emails message was lost are only picked up by this job
+        jobs = {job.name: job for job in PERIODIC_JOBS}
+        self.assertIs(jobs["send_queued_emails"].actor, send_queued_emails)
+        self.assertEqual(jobs["send_queued_emails"].interval, timedelta(minutes=5))
+
+
+class InitScriptCacheTests(TestCase):
+    def setUp(self):
+        cache.delete(INIT_SCRIPT_CACHE_KEY)
+        patcher = mock.patch("request.helpers.AppSettings.load",
+                             return_value=SimpleNamespace(init_script_url="https://example.com/init.sh"))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _response(self, status_code, text="", headers=None):
+        return mock.Mock(status_code=status_code, text=text, headers=headers or {},
+                         raise_for_status=mock.Mock())
+
+    def test_revalidates_with_etag_and_serves_cached_body_on_304(self):
+        with mock.patch("request.helpers.requests.get") as get:
+            get.return_value = self._response(200, "echo hello", {"ETag": '"v1"'})
+            self.assertEqual(fetch_init_script(), "echo hello")
+            self.assertEqual(fetch_init_script(), "echo hello")
+            self.assertEqual(get.call_count, 1)
+
+            get.return_value = self._response(304)
+            self.assertEqual(fetch_init_script(revalidate=True), "echo hello")
+            self.assertEqual(get.call_args.kwargs["headers"], {"If-None-Match": '"v1"'})
+
+    def test_serves_stale_body_when_script_host_fails(self):
+        with mock.patch("request.helpers.requests.get") as get:
+            get.return_value = self._response(200, "echo hello")
+            fetch_init_script()
+
+            get.side_effect = requests.ConnectionError("down")
+            self.assertEqual(fetch_init_script(revalidate=True), "echo hello")
+
+
+class AppSettingsCacheTests(TestCase):
+    def setUp(self):
+        self.app_settings = AppSettings(upcloud_api_url="https://api.upcloud.com", sandbox_mode=True)
+        self.app_settings.save()
+
+    def test_load_is_served_from_process_memory_until_saved(self):
+        loaded = AppSettings.load()
+        with mock.patch("request.models.cache.get", wraps=cache.get) as cache_get:
+            self.assertIs(AppSettings.load(), loaded)
+        cache_get.assert_called_once_with("AppSettings:version")
+
+    def test_save_invalidates_other_processes(self):
+        AppSettings.load()
+        # Another process saves the settings: the shared cache changes but this process' memory does not
+        other = AppSettings.objects.get(pk=1)
+        other.sandbox_mode = False
+        other.save()
+        AppSettings._local_cache["AppSettings"] = ("stale", self.app_settings)
+
+        self.assertFalse(AppSettings.load().sandbox_mode)
+
+
+class FernetEncryptedCharFieldTests(TestCase):
+    def setUp(self):
+        AppSettings(upcloud_api_username="user", upcloud_api_password="secret").save()
+
+    def test_values_are_decrypted_lazily_and_not_reencrypted_on_save(self):
+        with mock.patch("request.models.fernet", wraps=models.fernet) as fernet:
+            loaded = AppSettings.objects.get(pk=1)
+            fernet.decrypt.assert_not_called()
+
+            self.assertEqual(loaded.upcloud_api_password, "secret")
+            self.assertEqual(loaded.upcloud_api_password, "secret")
+            self.assertEqual(fernet.decrypt.call_count, 1)
+
+            loaded.save()
+            fernet.encrypt.assert_called_once_with(b"secret")
+
+    def test_rotate_encryption_keys_reencrypts_with_the_new_key(self):
+        old_key, new_key = Fernet(Fernet.generate_key()), Fernet(Fernet.generate_key())
+        with mock.patch("request.models.fernet", MultiFernet([old_key])):
+            AppSettings(upcloud_api_username="user", upcloud_api_password="secret").save()
+
+        with mock.patch("request.models.fernet", MultiFernet([new_key, old_key])):
+            call_command("rotate_encryption_keys", stdout=StringIO())
+
+        with mock.patch("request.models.fernet", MultiFernet([new_key])):
+            self.assertEqual(AppSettings.objects.get(pk=1).upcloud_api_password, "secret")
+
+
+class EmailOutboxTests(RequestTestCase):
+    def create_email(self, recipient):
+        return Email.objects.create(recipients=[recipient], subject="Hello", text_content="Hello")
+
+    def test_send_mailjet_batch_records_per_message_status(self):
+        emails = [self.create_email("ok@example.com"), self.create_email("bad@example.com")]
+        client = mock.Mock()
+        client.send.create.return_value = mock.Mock(status_code=400, json=mock.Mock(return_value={
+            "Messages": [{"Status": "success"}, {"Status": "error", "Errors": [{"ErrorMessage": "Invalid"}]}]
+        }))
+        with mock.patch("request.email.get_mailjet_client", return_value=client):
+            send_mailjet_batch(emails)
+
+        self.assertEqual(len(client.send.create.call_args.kwargs["data"]["Messages"]), 2)
+        ok, bad = Email.objects.order_by("pk")
+        self.assertEqual(ok.status, EmailStatus.SENT)
+        self.assertIsNotNone(ok.sent)
+        self.assertEqual(bad.status, EmailStatus.FAILED)
+        self.assertEqual(bad.delivery_status_json["Errors"][0]["ErrorMessage"], "Invalid")
+
+    def test_send_queued_emails_sends_in_batches_and_requeues_on_error(self):
+        for i in range(3):
+            self.create_email(f"user{i}@example.com")
+
+        with mock.patch("request.tasks.MAILJET_BATCH_SIZE", 2), \
+                mock.patch("request.tasks.send_mailjet_batch", side_effect=RuntimeError("Mailjet answered 503")):
+            with self.assertRaises(RuntimeError):
+                send_queued_emails()
+        self.assertEqual(Email.objects.filter(status=EmailStatus.QUEUED).count(), 3)
+
+        def deliver(emails):
+            Email.objects.filter(pk__in=[email.pk for email in emails]).update(status=EmailStatus.SENT)
+
+        with mock.patch("request.tasks.MAILJET_BATCH_SIZE", 2), \
+                mock.patch("request.tasks.send_mailjet_batch", side_effect=deliver) as send:
+            send_queued_emails()
+        self.assertEqual([len(call.args[0]) for call in send.call_args_list], [2, 1])
+        self.assertEqual(Email.objects.filter(status=EmailStatus.SENT).count(), 3)
+
+    def test_emails_left_sending_by_a_dead_worker_are_sent_again(self):
+        stale = self.create_email("stale@example.com")
+        fresh = self.create_email("fresh@example.com")
+        Email.objects.filter(pk=stale.pk).update(status=EmailStatus.SENDING,
+                                                 modified=timezone.now() - EMAIL_SENDING_TIMEOUT - timedelta(minutes=1))
+        Email.objects.filter(pk=fresh.pk).update(status=EmailStatus.SENDING, modified=timezone.now())
+
+        with mock.patch("request.tasks.send_mailjet_batch") as send:
+            send_queued_emails()
+
+        self.assertEqual([email.pk for email in send.call_args.args[0]], [stale.pk])
+
+    def test_request_received_emails_are_rendered_by_the_worker(self):
+        request = self.create_request(domain="myparty", party_start=date(2025, 6, 1))
+        self.assertFalse(Email.objects.exists())
+
+        send_request_received_emails(request.pk)
+
+        admin_email, customer_email = Email.objects.order_by("pk")
+        self.assertEqual(customer_email.recipients, ["myparty@example.com"])
+        self.assertIn("Party myparty", admin_email.subject)
+        self.assertNotIn("<style", customer_email.text_content)
+        self.assertEqual(customer_email.status, EmailStatus.QUEUED)
+
+    def test_plain_text_variant_is_computed_once_per_template(self):
+        requests = [self.create_request(domain=domain, party_start=date(2025, 6, 1)) for domain in ("first", "second")]
+        _text_template.cache_clear()
+
+        with mock.patch("request.email.strip_tags", wraps=strip_tags) as strip:
+            emails, failures = queue_request_emails(requests, "request-activated.html")
+
+        strip.assert_called_once()
+        self.assertEqual(failures, [])
+        self.assertIn("https://first.example.com", emails[0].text_content)
+        self.assertNotIn("<", emails[1].text_content)
+
+    def test_admin_email_action_queues_all_emails_for_one_send_job(self):
+        for domain in ("first", "second"):
+            self.create_request(domain=domain, party_start=date(2025, 6, 1))
+        model_admin = RequestAdmin(Request, AdminSite())
+
+        with mock.patch("request.admin.send_queued_emails") as send, \
+                mock.patch.object(model_admin, "message_user") as message_user, \
+                self.captureOnCommitCallbacks(execute=True):
+            model_admin.send_activation_email(self.factory.post("/"), Request.objects.all())
+
+        send.send.assert_called_once_with()
+        message_user.assert_called_once()
+        self.assertEqual(sorted(email.recipients[0] for email in Email.objects.all()),
+                         ["first@example.com", "second@example.com"])
+
+
+@override_settings(PROVIDER_LIMITER_URL="", PROVIDER_CONCURRENCY={"upcloud": 1, "cloudflare": 2})
+class BulkActivationTests(RequestTestCase):
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch("request.limits._backend", None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.model_admin = RequestAdmin(Request, AdminSite())
+        self.http_request = self.factory.post("/")
+        self.http_request.user = None
+
+    def test_deactivation_deletes_dns_records_in_one_batch_per_zone(self):
+        for domain in ("first", "second"):
+            request = self.create_request(domain=domain, party_start=date(2025, 6, 1),
+                                          activated=timezone.now() - timedelta(days=1))
+            request.cloudflare_dns_record_id = f"record-{domain}"
+            request.save()
+        self.create_request(domain="inactive", party_start=date(2025, 6, 1))
+        client = mock.Mock()
+        not_sandbox = SimpleNamespace(sandbox_mode=False)
+
+        with mock.patch("request.helpers.AppSettings.load", return_value=not_sandbox), \
+                mock.patch("request.tasks.AppSettings.load", return_value=not_sandbox), \
+                mock.patch("request.helpers.get_cloudflare_client", return_value=client), \
+                mock.patch("request.admin.delete_dns_records") as queued, \
+                mock.patch.object(self.model_admin, "message_user") as message_user:
+            with self.captureOnCommitCallbacks(execute=False) as callbacks:
+                response = self.model_admin.deactivate_requests(self.http_request, Request.objects.all())
+
+            # the admin action only queues, the batch is deleted by the worker
+            client.dns.records.batch.assert_not_called()
+            self.assertEqual(len(callbacks), 3)
+            callbacks[0]()
+            delete_dns_records(*queued.send.call_args.args)
+
+        client.dns.records.batch.assert_called_once_with(
+            zone_id="zone-1", deletes=[{"id": "record-first"}, {"id": "record-second"}])
+        message_user.assert_called_once()  # the inactive request was skipped
+        self.assertEqual(set(Request.objects.filter(provisioning_state=ProvisioningState.DEPROVISIONING)
+                             .values_list("domain", "cloudflare_dns_record_id")),
+                         {("first", None), ("second", None)})
+        self.assertTrue(response.url.startswith("/admin/request/request/bulk-status/?ids="))
+
+    def test_activation_skips_requests_that_have_been_deactivated(self):
+        zone = UpCloudZone.objects.create(name="fi-hel1")
+        plan = UpCloudPlan.objects.create(name="1xCPU-1GB", description="Small")
+        now = timezone.now()
+        for domain, deactivated in (("new", None), ("old", now - timedelta(days=1))):
+            request = self.create_request(domain=domain, party_start=date(2025, 6, 1),
+                                          activated=deactivated and now - timedelta(days=3), deactivated=deactivated)
+            request.upcloud_zone, request.upcloud_plan = zone, plan
+            request.save()
+
+        with mock.patch("request.tasks.AppSettings.load", return_value=SimpleNamespace(sandbox_mode=False)), \
+                mock.patch("request.admin.CloudflareDNSIndex"), \
+                mock.patch.object(self.model_admin, "message_user") as message_user, \
+                self.captureOnCommitCallbacks(execute=False) as callbacks:
+            self.model_admin.activate_requests(self.http_request, Request.objects.all())
+
+        self.assertEqual(len(callbacks), 1)
+        message_user.assert_called_once()
+        self.assertIn("it has been deactivated", message_user.call_args.args[1])
+        self.assertEqual(list(Request.objects.filter(provisioning_state=ProvisioningState.QUEUED)
+                              .values_list("domain", flat=True)), ["new"])
+
+    def test_bulk_states_are_read_from_the_database_in_one_request(self):
+        queued = self.create_request(domain="queued", party_start=date(2025, 6, 1))
+        failed = self.create_request(domain="failed", party_start=date(2025, 6, 1))
+        Request.objects.filter(pk=queued.pk).update(provisioning_state=ProvisioningState.QUEUED)
+        Request.objects.filter(pk=failed.pk).update(provisioning_state=ProvisioningState.FAILED,
+                                                    provisioning_error="DNS record exists")
+
+        with mock.patch("request.helpers.get_upcloud_client") as upcloud, \
+                mock.patch("request.helpers.get_cloudflare_client") as cloudflare, \
+                self.assertNumQueries(1):
+            response = self.model_admin.bulk_states_view(self.factory.get("/", {"ids": f"{queued.pk},{failed.pk}"}))
+
+        upcloud.assert_not_called()
+        cloudflare.assert_not_called()
+        states = json.loads(response.content)
+        self.assertTrue(states[str(queued.pk)]["in_progress"])
+        self.assertEqual(states[str(failed.pk)], {"state_display": ProvisioningState.FAILED.label,
+                                                  "in_progress": False, "error": "DNS record exists"})
+
+    def test_provider_slots_are_capped(self):
+        with mock.patch("request.limits.SLOT_WAIT", 0.1):
+            with provider_slot("upcloud"):
+                with self.assertRaises(ProviderBusy):
+                    with provider_slot("upcloud"):
+                        pass
+            with provider_slot("cloudflare"), provider_slot("cloudflare"):
+                pass
+
+
+class MetricsTests(TestCase):
+    def _sample(self, name, **labels):
+        return REGISTRY.get_sample_value(name, labels) or 0
+
+    def test_external_call_is_timed_and_errors_are_counted_by_status_or_exception(self):
+        count = self._sample("partyman_external_call_seconds_count", service="test", operation="call")
+        with external_call("test", "call") as call:
+            call.record_status(404, expected=(404,))
+        with external_call("test", "call") as call:
+            call.record_status(503)
+        with self.assertRaises(requests.ConnectionError), external_call("test", "call"):
+            raise requests.ConnectionError("down")
+
+        self.assertEqual(self._sample("partyman_external_call_seconds_count", service="test", operation="call"),
+                         count + 3)
+        self.assertEqual(self._sample("partyman_external_call_errors_total", service="test", operation="call",
+                                      error="http_503"), 1)
+        self.assertEqual(self._sample("partyman_external_call_errors_total", service="test", operation="call",
+                                      error="ConnectionError"), 1)
+        self.assertEqual(self._sample("partyman_external_call_errors_total", service="test", operation="call",
+                                      error="http_404"), 0)
+
+    @override_settings(METRICS_TOKEN="secret", PROMETHEUS_MULTIPROC_DIRS=[])
+    def test_metrics_endpoint_serves_view_timings_and_queue_depth(self):
+        broker = mock.Mock(namespace="dramatiq")
+        broker.get_declared_queues.return_value = {"default"}
+        broker.get_declared_delay_queues.return_value = {"default.DQ"}
+        broker.client.pipeline.return_value.execute.return_value = [3, 1, 2]
+
+        self.assertEqual(self.client.get("/metrics").status_code, 401)
+        with mock.patch("request.metrics.dramatiq.get_broker", return_value=broker):
+            response = self.client.get("/metrics", HTTP_AUTHORIZATION="Bearer secret")
+
+        body = response.content.decode()
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('partyman_view_seconds_count{method="GET",status="401",view="request:metrics"}', body)
+        self.assertIn('partyman_dramatiq_queue_messages{queue="default"} 3.0', body)
+        self.assertIn('partyman_dramatiq_queue_messages{queue="default.DQ"} 1.0', body)
+        self.assertIn('partyman_dramatiq_queue_messages{queue="default.XQ"} 2.0', body)
+
+    def test_multiprocess_directories_that_do_not_exist_yet_are_skipped(self):
+        with tempfile.TemporaryDirectory() as path:
+            registry = build_registry([path, f"{path}/not-started"])
+            with mock.patch("request.metrics.dramatiq.get_broker", return_value=mock.Mock(spec=[])):
+                self.assertIsNotNone(generate_latest(registry))
+
+
+class LandingPageViewTests(TestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.item = PortfolioItem.objects.create(heading="Assembly", sort_order=1)
+
+    def get(self):
+        request = self.factory.get("/")
+        request.user = AnonymousUser()
+        return LandingPageView.as_view()(request)
+
+    def test_page_is_served_from_cache_until_portfolio_changes(self):
+        self.assertIn(b"Assembly", self.get().content)
+        with self.assertNumQueries(0):
+            self.assertIn(b"Assembly", self.get().content)
+
+        ExternalURL.objects.create(portfolio_item=self.item, title="Pouet", url="https://www.pouet.net/")
+        self.assertIn(b"https://www.pouet.net/", self.get().content)
+
+    def test_cached_page_is_rendered_again_in_a_new_year(self):
+        self.get()
+        next_year = timezone.now().replace(year=timezone.now().year + 1)
+        with mock.patch("request.views.timezone.now", return_value=next_year):
+            self.assertIn(f"2020-{next_year.year}".encode(), self.get().content)
+
+    def _render_portfolio(self):
+        view = LandingPageView()
+        view.request = self.factory.get("/")
+        return render_to_string("landingpage/index.html", {"object_list": view.get_queryset()})
+
+    def test_portfolio_is_rendered_with_a_fixed_number_of_queries(self):
+        for i in range(5):
+            item = PortfolioItem.objects.create(heading=f"Party {i}", sort_order=i)
+            ExternalURL.objects.create(portfolio_item=item, title="Site", url=f"https://party{i}.example.com/")
+            ExternalURL.objects.create(portfolio_item=item, title="Hidden", url="https://hidden.example.com/",
+                                       visible=False)
+            Testimonial.objects.create(portfolio_item=item, by="Orga", text=f"Thanks from party {i}")
+
+        with self.assertNumQueries(3):
+            content = self._render_portfolio()
+
+        self.assertIn("https://party4.example.com/", content)
+        self.assertNotIn("https://hidden.example.com/", content)
+
+
+class PortfolioImageDerivativeTests(TestCase):
+    def setUp(self):
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        settings_override = override_settings(MEDIA_ROOT=media_root.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def test_derivatives_are_generated_without_upscaling(self):
+        buffer = BytesIO()
+        Image.new("RGB", (1200, 500), "red").save(buffer, format="PNG")
+        item = PortfolioItem.objects.create(heading="Assembly",
+                                            image=SimpleUploadedFile("assembly.png", buffer.getvalue()))
+        self.assertEqual(item.image_sources(), [])
+
+        generate_portfolio_image_derivatives(item.pk)
+
+        item.refresh_from_db()
+        self.assertFalse(item.image_derivatives_stale)
+        for derivatives in item.image_derivatives["formats"].values():
+            self.assertEqual([d["width"] for d in derivatives], [480, 960, 1200])
+            self.assertTrue(all(item.image.storage.exists(d["name"]) for d in derivatives))
+        type, srcset = item.image_sources()[-1]
+        self.assertEqual(type, "image/webp")
+        self.assertTrue(srcset.endswith(".webp 1200w"))
+
+    def test_derivatives_of_a_replaced_image_are_deleted(self):
+        buffer = BytesIO()
+        Image.new("RGB", (600, 300), "red").save(buffer, format="PNG")
+        item = PortfolioItem.objects.create(heading="Assembly",
+                                            image=SimpleUploadedFile("assembly.png", buffer.getvalue()))
+        generate_portfolio_image_derivatives(item.pk)
+        item.refresh_from_db()
+        previous = [d["name"] for formats in item.image_derivatives["formats"].values() for d in formats]
+        self.assertTrue(previous)
+
+        buffer = BytesIO()
+        Image.new("RGB", (600, 300), "blue").save(buffer, format="PNG")
+        item.image = SimpleUploadedFile("assembly.png", buffer.getvalue())
+        item.save()
+        generate_portfolio_image_derivatives(item.pk)
+
+        item.refresh_from_db()
+        self.assertFalse(any(item.image.storage.exists(name) for name in previous))
+        for derivatives in item.image_derivatives["formats"].values():
+            self.assertTrue(all(item.image.storage.exists(d["name"]) for d in derivatives))
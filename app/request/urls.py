@@ -1,5 +1,6 @@
 from django.urls import path
-from request.views import LandingPageView, RequestIndexView, SuccessView, ActivationDetailView, ActivationListView
+from request.views import LandingPageView, RequestIndexView, SuccessView, ActivationDetailView, ActivationListView, \
+    ActivationStatusView, MetricsView
 
 app_name = "request"
 
@@ -9,4 +10,6 @@ urlpatterns = [
     path('success/', SuccessView.as_view(), name='success'),
     path('activation/', ActivationListView.as_view(), name="activation-list"),
     path('activation/<int:pk>/', ActivationDetailView.as_view(), name='activation-detail'),
+    path('activation/<int:pk>/status/', ActivationStatusView.as_view(), name='activation-status'),
+    path('metrics', MetricsView.as_view(), name='metrics'),
 ]
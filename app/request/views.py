@@ -1,22 +1,51 @@
-from django.db.models import Avg, Case, DateTimeField, DurationField, ExpressionWrapper, F, Value, When, Count
+from datetime import date
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, DateTimeField, DurationField, ExpressionWrapper, F, Value, When, \
+    Prefetch, Q
 from django.db.models.functions import Coalesce
-from django.http import HttpResponseRedirect
+from django.http import Http404, HttpResponse, HttpResponseRedirect, JsonResponse
 from django.urls import reverse_lazy
-from django.views.generic import CreateView, TemplateView, UpdateView, ListView
+from django.utils.crypto import constant_time_compare
+from django.views.generic import CreateView, TemplateView, UpdateView, ListView, View
 from django.utils import timezone
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
 
+from request.caching import LANDING_PAGE, get_version, single_flight
 from request.forms import RequestForm, ActivationForm
-from request.helpers import get_cloudflare_dns_records, create_cloudflare_dns_entry, create_upcloud_server, \
-    delete_cloudflare_dns_entry, stop_upcloud_server, delete_upcloud_server
-from request.models import Request, PortfolioItem, AppSettings
+from request.metrics import build_registry
+from request.models import ActivationStatistic, Request, PortfolioItem, ExternalURL, Testimonial, ProvisioningState
+from request.tasks import queue_activation, queue_deactivation
 
 
 class LandingPageView(ListView):
     template_name = "landingpage/index.html"
     model = PortfolioItem
 
+    # The rendered page is cached until portfolio content changes, see signals.py
+    cache_timeout = 60 * 60 * 24
+
+    def get(self, request, *args, **kwargs):
+        if request.user.is_staff:
+            # Staff get an extra navigation link, their page is not cached
+            return super().get(request, *args, **kwargs)
+
+        def render():
+            return super(LandingPageView, self).get(request, *args, **kwargs).render().content
+
+        # the footer shows the current year, a new year starts a new cache entry
+        key = f"{LANDING_PAGE}:{get_version(LANDING_PAGE)}:{timezone.localdate().year}"
+        return HttpResponse(single_flight(key, render, self.cache_timeout))
+
     def get_queryset(self):
-        return self.model.objects.filter(visible=True).order_by("sort_order")
+        # Three queries however many items there are: visibility and ordering of the related rows are done in SQL
+        return self.model.objects.filter(visible=True).order_by("sort_order").prefetch_related(
+            Prefetch("external_urls", to_attr="visible_external_urls",
+                     queryset=ExternalURL.objects.filter(visible=True).order_by("sort_order")),
+            Prefetch("testimonials", to_attr="visible_testimonials",
+                     queryset=Testimonial.objects.filter(visible=True).order_by("created")),
+        )
 
     def get_context_data(self, **kwargs):
         ctx = super().get_context_data(**kwargs)
@@ -37,31 +66,73 @@ class SuccessView(TemplateView):
 
 class ActivationListView(ListView):
     template_name = "request/activation-list.html"
+    paginate_by = 50
+    filters = ("zone", "plan", "year")
+
+    def get_template_names(self):
+        # Pages after the first one are fetched by the "Load more" button and only need the rows
+        if self.request.GET.get("partial"):
+            return ["request/activation-list-rows.html"]
+        return super().get_template_names()
+
+    def get_filters(self):
+        return {name: self.request.GET.get(name, "") for name in self.filters}
+
+    def paginate_queryset(self, queryset, page_size):
+        """
+        Keyset pagination on the (is_inactive, -party_start, -pk) ordering: a page is the rows after the last row
+        of the previous page, so unlike OFFSET its cost does not grow with the number of past requests.
+        """
+        after = self.request.GET.get("after")
+        if after:
+            try:
+                is_inactive, party_start, pk = after.split("_")
+                is_inactive, party_start, pk = int(is_inactive), date.fromisoformat(party_start), int(pk)
+            except ValueError:
+                raise Http404("Invalid cursor")
+            queryset = queryset.filter(
+                Q(is_inactive__gt=is_inactive)
+                | Q(is_inactive=is_inactive, party_start__lt=party_start)
+                | Q(is_inactive=is_inactive, party_start=party_start, pk__lt=pk)
+            )
+
+        rows = list(queryset[:page_size + 1])
+        has_next = len(rows) > page_size
+        rows = rows[:page_size]
+        self.next_url = None
+        if has_next:
+            last = rows[-1]
+            params = self.request.GET.copy()
+            params["after"] = f"{last.is_inactive}_{last.party_start.isoformat()}_{last.pk}"
+            params["partial"] = "1"
+            self.next_url = f"{self.request.path}?{params.urlencode()}"
+        return None, None, rows, has_next
 
     def get_context_data(self, **kwargs):
         ctx = super().get_context_data(**kwargs)
-        ctx["zones"] = list(Request.objects
-                            .values("upcloud_zone__name")
-                            .filter(upcloud_zone__name__isnull=False)
-                            .annotate(count=Count("upcloud_zone__name")).order_by("-count"))
-        ctx["plans"] = list(Request.objects
-                            .values("upcloud_plan__name")
-                            .filter(upcloud_plan__name__isnull=False)
-                            .annotate(count=Count("upcloud_plan__name")).order_by("-count"))
-        ctx["average_duration_activated"] = (Request.objects.filter(activated__isnull=False, deactivated__isnull=False)
-        .aggregate(
-            avg_duration=Avg(
-                ExpressionWrapper(F("deactivated") - F("activated"), output_field=DurationField())
-            )
-        )["avg_duration"])
+        ctx["next_url"] = self.next_url
+        if self.request.GET.get("partial"):
+            return ctx
+        ctx["filters"] = self.get_filters()
+        ctx["years"] = Request.objects.dates("party_start", "year", order="DESC")
+        statistics = ActivationStatistic.objects.order_by("-count", "name")
+        ctx["zones"] = [stat for stat in statistics if stat.kind == ActivationStatistic.Kind.ZONE and stat.count]
+        ctx["plans"] = [stat for stat in statistics if stat.kind == ActivationStatistic.Kind.PLAN and stat.count]
+        duration = next((stat for stat in statistics if stat.kind == ActivationStatistic.Kind.DURATION), None)
+        ctx["average_duration_activated"] = duration.average_duration if duration else None
         return ctx
 
     def get_queryset(self):
-        return Request.objects.prefetch_related("activated_by", "deactivated_by", "upcloud_zone").annotate(
-            is_inactive=Case(
-                When(activated__isnull=False, deactivated__isnull=True, then=Value(0)),
-                default=Value(1),
-            ),
+        queryset = Request.objects.all()
+        filters = self.get_filters()
+        if filters["zone"]:
+            queryset = queryset.filter(upcloud_zone__name=filters["zone"])
+        if filters["plan"]:
+            queryset = queryset.filter(upcloud_plan__name=filters["plan"])
+        if filters["year"].isdigit():
+            queryset = queryset.filter(party_start__year=int(filters["year"]))
+
+        return queryset.prefetch_related("activated_by", "deactivated_by", "upcloud_zone").annotate(
             duration_activated=Case(
                 When(
                     activated__isnull=False,
@@ -75,7 +146,7 @@ class ActivationListView(ListView):
                 ),
                 default=Value(None, output_field=DurationField()),
             )
-        ).order_by("is_inactive", "-party_start")
+        ).order_by("is_inactive", "-party_start", "-pk")
 
 
 class ActivationDetailView(UpdateView):
@@ -84,6 +155,11 @@ class ActivationDetailView(UpdateView):
     form_class = ActivationForm
     success_url = reverse_lazy('request:success')
 
+    def get_context_data(self, **kwargs):
+        ctx = super().get_context_data(**kwargs)
+        ctx["in_progress_states"] = ProvisioningState.in_progress()
+        return ctx
+
     def get_form_kwargs(self):
         kwargs = super().get_form_kwargs()
         kwargs.update({'approved': self.get_object().is_approved})
@@ -91,36 +167,52 @@ class ActivationDetailView(UpdateView):
         return kwargs
 
     def form_valid(self, form):
-        settings = AppSettings.load()
+        if form.instance.provisioning_state in ProvisioningState.in_progress():
+            form.add_error(None, f"Request is busy: {form.instance.get_provisioning_state_display()}")
+            return self.form_invalid(form)
+        # The actors are enqueued on commit, so a worker never sees the request before it has been saved
         if "Deactivate" in self.request.POST["submit"]:
             request = self.get_object()
             form.instance.cloudflare_zone = request.cloudflare_zone
             form.instance.domain = request.domain
-            form.instance.deactivated_by = self.request.user
-            form.instance.deactivated = timezone.now()
-            if not settings.sandbox_mode:
-                stop_upcloud_server(form.instance)
-                delete_cloudflare_dns_entry(form.instance.cloudflare_zone, form.instance.cloudflare_dns_record_id)
-                delete_upcloud_server(form.instance)
-            form.save()
+            with transaction.atomic():
+                # Stopping and deleting the server is polled by deprovision_request in tasks.py
+                queue_deactivation(form.instance, self.request.user)
+                form.save()
             return HttpResponseRedirect(reverse_lazy("request:activation-list"))
-        else:
-            # print(type(form.instance), vars(form.instance))
-            if not settings.sandbox_mode:
-                domain = form.instance.domain + "." + form.instance.cloudflare_zone.name
-                if domain in [record.name for record in get_cloudflare_dns_records(form.instance.cloudflare_zone)]:
-                    form.add_error('domain', f"Domain {domain} already exists")
-                    return self.form_invalid(form)
-
-                server_id, server_address = create_upcloud_server(form.instance)
-                if not server_id or not server_address:
-                    form.add_error(None, "Failed to create UpCloud server")
-                    return self.form_invalid(form)
-                cf_dns_id = create_cloudflare_dns_entry(form.instance.cloudflare_zone, form.instance.domain,
-                                                        server_address)
-                form.instance.cloudflare_dns_record_id = cf_dns_id
-            form.instance.is_approved = True
-            form.instance.activated_by = self.request.user
-            form.instance.activated = timezone.now()
-
-        return super().form_valid(form)
+
+        with transaction.atomic():
+            # The server, DNS record and activation email are handled by the pipeline in tasks.py
+            queue_activation(form.instance, self.request.user)
+            return super().form_valid(form)
+
+
+class ActivationStatusView(View):
+    """
+    Status of a request for the activation detail page, polled while provisioning is in progress. Read from the
+    database like the admin bulk status page, the provisioning actors record every step there, so polling never
+    calls the providers. The view is async so that under ASGI a poll does not hold a worker thread.
+    """
+
+    async def get(self, request, pk):
+        obj = await Request.objects.filter(pk=pk).afirst()
+        if obj is None:
+            raise Http404("No such request")
+        return JsonResponse({
+            "state": obj.provisioning_state,
+            "state_display": obj.get_provisioning_state_display(),
+            "in_progress": obj.provisioning_state in ProvisioningState.in_progress(),
+            "error": obj.provisioning_error,
+            "log": obj.provisioning_log,
+        })
+
+
+class MetricsView(View):
+    """Prometheus metrics of every web and worker process, see request/metrics.py"""
+
+    def get(self, request):
+        token = settings.METRICS_TOKEN
+        if token and not constant_time_compare(request.headers.get("Authorization", ""), f"Bearer {token}"):
+            return HttpResponse(status=401)
+        registry = build_registry(settings.PROMETHEUS_MULTIPROC_DIRS)
+        return HttpResponse(generate_latest(registry), content_type=CONTENT_TYPE_LATEST)